@@ -0,0 +1,340 @@
+"""
+Benchmark of the update pipeline against local stand-in servers, no internet
+access is needed: python benchmark.py --channels 100 1000 10000
+"""
+
+try:
+    import user_config as config
+except ImportError:
+    import config
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+import zlib
+from aiohttp import web
+import utils
+from utils import (
+    getChannelsByExtendBaseUrls,
+    getProbeEngine,
+    closeProbeEngine,
+    sortUrlsBySpeedAndResolution,
+    getUrlScores,
+    getTotalUrls,
+    ChannelCandidates,
+    ChannelNameIndex,
+    ResultWriter,
+)
+from main import UpdateSource
+
+stages = ["extend", "filter", "search", "parse", "probe", "rank", "write"]
+
+
+def getChannelName(index):
+    return f"BENCH{index}"
+
+
+def getStableRatio(text):
+    """
+    Get a stable value in [0, 1) of the text, the same url always behaves the same
+    """
+    return zlib.crc32(text.encode("utf-8")) / 2**32
+
+
+class StandInServer:
+    """
+    Local stand-in of the extend sources, the search site and the iptv endpoints,
+    served on several ports so every port counts as its own host
+    """
+
+    def __init__(self, args):
+        self.hosts = args.hosts
+        self.latency = args.latency / 1000
+        self.failure_rate = args.failure_rate
+        self.extend_urls = args.extend_urls
+        self.results = args.results
+        self.segment_bytes = args.segment_bytes
+        self.segment_kbps = args.segment_kbps
+        self.ports = []
+
+    def getStreamUrl(self, key):
+        port = self.ports[int(getStableRatio(key) * len(self.ports))]
+        return f"http://127.0.0.1:{port}/live/{key}.m3u8"
+
+    async def extendSource(self, request):
+        source = request.match_info["source"]
+        count = int(request.query.get("channels", 0))
+        lines = ["央视频道,#genre#"]
+        for index in range(count):
+            name = getChannelName(index)
+            for i in range(self.extend_urls):
+                # Spelled like the sources do, to exercise the name index
+                extend_name = f"{name[:5]}-{name[5:]} HD_(1920x1080)" if i % 2 else name
+                lines.append(f"{extend_name},{self.getStreamUrl(f'{source}_{name}_{i}')}")
+        return web.Response(text="\n".join(lines) + "\n")
+
+    async def searchPage(self, request):
+        if request.method == "POST":
+            data = await request.post()
+            name = data.get("search", "")
+            page = 1
+        else:
+            name = request.query.get("s")
+            page = int(request.query.get("page", 1))
+        if not name:
+            return web.Response(
+                text='<html><body><form method="post" action="/search">'
+                '<input type="text" name="search"><input type="submit" name="Submit" value="Search">'
+                "</form></body></html>",
+                content_type="text/html",
+            )
+        date = datetime.datetime.now().strftime("%m-%d-%Y")
+        rows = []
+        for i in range(self.results):
+            url = self.getStreamUrl(f"search_{name}_{page}_{i}")
+            # Every other row is a longer channel name, which must not match
+            row_name = name if i % 2 == 0 else f"{name}{i}"
+            rows.append(
+                '<div class="resultplus"><div class="channel"><div style="float: left;">'
+                f"{row_name}</div></div>"
+                f'<div class="m3u8"><table><tr><td>{url}</td></tr></table></div>'
+                '<div style="display: none;">hidden</div>'
+                f'<div style="font-size: 10px; color: #666;">{date} 20:00 •1920x1080 stand-in</div></div>'
+            )
+        links = [f'<a href="?page={page+1}&s={name}">{page+1}</a>']
+        return web.Response(
+            text=f"<html><body>{''.join(rows)}<div class='pages'>{''.join(links)}</div></body></html>",
+            content_type="text/html",
+        )
+
+    async def playlist(self, request):
+        key = request.match_info["key"]
+        ratio = getStableRatio(key)
+        await asyncio.sleep(self.latency * (0.5 + ratio))
+        if getStableRatio(key[::-1]) < self.failure_rate:
+            raise web.HTTPNotFound()
+        segments = "".join(f"#EXTINF:4.0,\n{key}_{i}.ts\n" for i in range(3))
+        return web.Response(
+            text=f"#EXTM3U\n#EXT-X-TARGETDURATION:4\n#EXT-X-MEDIA-SEQUENCE:0\n{segments}",
+            content_type="application/vnd.apple.mpegurl",
+        )
+
+    async def segment(self, request):
+        response = web.StreamResponse()
+        response.content_type = "video/mp2t"
+        await response.prepare(request)
+        chunk = b"\0" * 16384
+        delay = len(chunk) * 8 / 1000 / self.segment_kbps
+        sent = 0
+        while sent < self.segment_bytes:
+            await response.write(chunk)
+            sent += len(chunk)
+            await asyncio.sleep(delay)
+        return response
+
+    async def serve(self, ready, stop):
+        app = web.Application()
+        app.router.add_get("/extend/{source}.txt", self.extendSource)
+        app.router.add_route("*", "/search", self.searchPage)
+        app.router.add_get("/live/{key}.m3u8", self.playlist)
+        app.router.add_get("/live/{key}.ts", self.segment)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        sites = [web.TCPSite(runner, "127.0.0.1", 0) for _ in range(self.hosts)]
+        for site in sites:
+            await site.start()
+            self.ports.append(site._server.sockets[0].getsockname()[1])
+        ready.put(self.ports)
+        await asyncio.get_running_loop().run_in_executor(None, stop.wait)
+        await runner.cleanup()
+
+    def run(self, ready, stop):
+        asyncio.run(self.serve(ready, stop))
+
+
+def configure(args, port, count):
+    """
+    Point the config at the stand-in server, without the caches between runs
+    """
+    config.extend_base_urls = [
+        f"http://127.0.0.1:{port}/extend/source{i+1}.txt?channels={count}"
+        for i in range(args.sources)
+    ]
+    config.extend_cache_file = ""
+    config.source_registry_file = ""
+    config.probe_cache_ttl = 0
+    config.probe_stream = args.stream
+    config.favorite_list = []
+    config.default_page_num = args.pages
+    config.domain_blacklist = []
+    config.url_keywords_blacklist = []
+    utils.loadSettings()
+    utils.probe_cache = None
+    utils.source_registry = None
+    utils.url_filter = None
+    utils.normalizeChannelName.cache_clear()
+    utils.getExtendKey.cache_clear()
+
+
+async def runPipeline(args, port, count):
+    """
+    Run the stages of the update over count channels, return the stage timings
+    """
+    names = [getChannelName(index) for index in range(count)]
+    categories = {}
+    for index, name in enumerate(names):
+        categories.setdefault(f"Category{index // 100 + 1}", {})[name] = []
+    timings = {}
+    counts = {}
+
+    start = time.perf_counter()
+    name_index = ChannelNameIndex(names)
+    extendResults = await getChannelsByExtendBaseUrls(names, name_index)
+    timings["extend"] = time.perf_counter() - start
+    counts["extend"] = sum(len(urls) for urls in extendResults.values())
+
+    updater = UpdateSource()
+    updater.name_index = name_index
+    start = time.perf_counter()
+    infoLists = {}
+    for channelObj in categories.values():
+        for name in channelObj.keys():
+            infoLists[name] = await updater.collectChannel(
+                name, channelObj, extendResults, []
+            )
+    timings["filter"] = time.perf_counter() - start
+    counts["filter"] = sum(len(infoList) for infoList in infoLists.values())
+
+    pageUrl = f"http://127.0.0.1:{port}/search"
+    semaphore = asyncio.Semaphore(args.search_concurrency)
+
+    async def search(name):
+        async with semaphore:
+            return await updater.searchChannelByHttp(
+                name, pageUrl, "resultplus", infoLists[name].copy()
+            )
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(search(name) for name in names))
+    infoLists = dict(zip(names, results))
+    timings["search"] = time.perf_counter() - start
+    counts["search"] = sum(len(infoList) for infoList in infoLists.values())
+
+    # The parsing alone, on one result page per channel fetched beforehand
+    session = getProbeEngine().getSession()
+    pages = {}
+    for name in names[: args.parse_sample]:
+        async with session.get(pageUrl, params={"s": name, "page": 1}) as response:
+            pages[name] = await response.text()
+    start = time.perf_counter()
+    for name, page_source in pages.items():
+        updater.parseSearchPage(name, 1, page_source, "resultplus", ChannelCandidates())
+    timings["parse"] = (time.perf_counter() - start) * count / max(len(pages), 1)
+    counts["parse"] = count
+
+    start = time.perf_counter()
+    sorted_data = await asyncio.gather(
+        *(sortUrlsBySpeedAndResolution(infoLists[name].toList()) for name in names)
+    )
+    timings["probe"] = time.perf_counter() - start
+    counts["probe"] = counts["search"]
+
+    start = time.perf_counter()
+    channelUrls = {}
+    for name, data in zip(names, sorted_data):
+        scores = getUrlScores(data)
+        order = sorted(range(len(data)), key=scores.__getitem__, reverse=True)
+        channelUrls[name] = getTotalUrls([data[i] for i in order])
+    timings["rank"] = time.perf_counter() - start
+    counts["rank"] = sum(len(data) for data in sorted_data)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        writer = ResultWriter(
+            os.path.join(tmp, "result.txt"),
+            os.path.join(tmp, "result.m3u"),
+            os.path.join(tmp, "result.checkpoint.json"),
+        ).open()
+        for cate, channelObj in categories.items():
+            writer.write(cate, {name: channelUrls[name] for name in channelObj.keys()})
+        writer.close()
+        timings["write"] = time.perf_counter() - start
+        counts["write"] = sum(len(urls) for urls in channelUrls.values())
+
+    updater.closeDrivers()
+    await closeProbeEngine()
+    return timings, counts
+
+
+def printReport(count, timings, counts):
+    print(f"\n{count} channels")
+    print(f"{'stage':<8}{'seconds':>10}{'items':>10}{'items/s':>12}")
+    for stage in stages:
+        seconds = timings[stage]
+        rate = counts[stage] / seconds if seconds > 0 else float("inf")
+        print(f"{stage:<8}{seconds:>10.3f}{counts[stage]:>10}{rate:>12.0f}")
+    print(f"{'total':<8}{sum(timings.values()):>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the update stages against local stand-in servers"
+    )
+    parser.add_argument("--channels", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--hosts", type=int, default=16, help="Stand-in iptv hosts")
+    parser.add_argument("--sources", type=int, default=2, help="Extend sources")
+    parser.add_argument(
+        "--extend-urls", type=int, default=2, help="Urls per channel in each source"
+    )
+    parser.add_argument("--results", type=int, default=4, help="Rows per result page")
+    parser.add_argument("--pages", type=int, default=1, help="Result pages per channel")
+    parser.add_argument(
+        "--search-concurrency", type=int, default=8, help="Parallel channel searches"
+    )
+    parser.add_argument(
+        "--parse-sample", type=int, default=200, help="Result pages timed in the parse stage"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=20, help="Mean endpoint latency (ms)"
+    )
+    parser.add_argument(
+        "--failure-rate", type=float, default=0.2, help="Share of failing endpoints"
+    )
+    parser.add_argument("--stream", action="store_true", help="Deep probe the streams")
+    parser.add_argument("--segment-bytes", type=int, default=262144)
+    parser.add_argument(
+        "--segment-kbps", type=float, default=8000, help="Segment download rate"
+    )
+    parser.add_argument("--output", help="Also write the timings as json to this file")
+    args = parser.parse_args()
+
+    # The stand-in server runs in its own process, so its work is not timed
+    server = StandInServer(args)
+    ready = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    process = multiprocessing.Process(target=server.run, args=(ready, stop), daemon=True)
+    process.start()
+    report = []
+    try:
+        port = ready.get(timeout=30)[0]
+        for count in args.channels:
+            configure(args, port, count)
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                timings, counts = asyncio.run(runPipeline(args, port, count))
+            printReport(count, timings, counts)
+            report.append({"channels": count, "timings": timings, "counts": counts})
+    finally:
+        stop.set()
+        process.join(5)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
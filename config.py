@@ -22,3 +22,27 @@ extend_base_urls = [
     "https://fanmingming.com/txt?url=https://github.moeyy.xyz/https://raw.githubusercontent.com/YueChan/Live/main/IPTV.m3u",
     "https://github.moeyy.xyz/https://raw.githubusercontent.com/dxawi/0/main/tvlive.txt",
 ]
+probe_concurrency = 50
+probe_per_host = 4
+probe_cache_file = "probe_cache.json"
+probe_cache_ttl = 6
+probe_cache_negative_ttl = 1
+probe_cache_size = 20000
+driver_pool_size = 1
+search_backend = "selenium"
+extend_cache_file = "extend_cache.json"
+probe_stream = False
+probe_segment_bytes = 524288
+probe_segment_timeout = 5
+speed_weight = 0
+probe_adaptive = False
+probe_host_fail_threshold = 3
+incremental_update = False
+incremental_window = 24
+checkpoint_interval = 60
+channel_alias = {}
+metrics_file = ""
+search_urls = ["http://www.foodieguide.com/iptvsearch/", "http://tonkiang.us/"]
+source_registry_file = "source_registry.json"
+source_skip_runs = 3
+source_max_latency = 20000
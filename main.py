@@ -1,43 +1,67 @@
-try:
-    import user_config as config
-except ImportError:
-    import config
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium_stealth import stealth
 import asyncio
-from bs4 import BeautifulSoup
 from utils import (
     getChannelItems,
-    updateChannelUrlsTxt,
+    ResultWriter,
     updateFile,
     getUrlInfo,
+    getSearchResults,
     sortUrlsBySpeedAndResolution,
     getTotalUrls,
     filterUrlsByPatterns,
     useAccessibleUrl,
     getChannelsByExtendBaseUrls,
     checkUrlByPatterns,
+    closeProbeEngine,
+    saveProbeCache,
+    getProbeEngine,
+    getSearchFormRequest,
+    fetchSearchPage,
+    ChannelCandidates,
+    logProbeHostStats,
+    UpdateManifest,
+    RunCheckpoint,
+    getShardChannelItems,
+    getChannelItemsByFile,
+    ChannelNameIndex,
+    getMetrics,
+    writeRunMetrics,
+    getSettings,
+    loadSettings,
+    getShardPath,
+    loadJson,
+    saveJsonAtomic,
+    getSourceRegistry,
+    saveSourceRegistry,
+    getCandidateSources,
 )
 import logging
 from logging.handlers import RotatingFileHandler
 import os
-from tqdm import tqdm
 import re
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
 
-handler = RotatingFileHandler("result_new.log", encoding="utf-8")
-logging.basicConfig(
-    handlers=[handler],
-    format="%(message)s",
-    level=logging.INFO,
-)
+
+def setupLogging(log_file):
+    handler = RotatingFileHandler(log_file, encoding="utf-8")
+    logging.basicConfig(
+        handlers=[handler],
+        format="%(message)s",
+        level=logging.INFO,
+    )
 
 
 class UpdateSource:
 
     def setup_driver(self):
+        # The browser modules are only imported once a search needs a driver
+        from selenium import webdriver
+        from selenium_stealth import stealth
+
         options = webdriver.ChromeOptions()
         options.add_argument("start-maximized")
         options.add_argument("--headless")
@@ -59,151 +83,670 @@ class UpdateSource:
         )
         return driver
 
-    def __init__(self):
-        self.driver = self.setup_driver()
+    def __init__(self, shard=None):
+        # A shard (index, count) processes every count-th channel of the source
+        # file and writes its partial result to result_shard{index}.txt
+        self.shard = shard
+        if shard is not None:
+            loadSettings(shard=shard)
+        self.run_name = "result_new" if shard is None else f"result_shard{shard[0]}"
+        self.search_backend = getSettings().search_backend
+        self.driver_pool_size = max(1, getSettings().driver_pool_size)
+        self.executor = ThreadPoolExecutor(max_workers=self.driver_pool_size)
+        self.drivers = queue.Queue()
+        # Every driver started, the idle ones in the queue and the checked out ones
+        self.all_drivers = []
+        self.driver_count = 0
+        self.driver_lock = threading.Lock()
+        self.search_semaphore = None
+        self.name_index = None
+        # The search site that served each channel, and the failures of the sites
+        self.search_sites = {}
+        self.search_failures = {}
+        self.checkpoint = RunCheckpoint(f"{self.run_name}.progress.json")
+
+    def getDriver(self):
+        """
+        Get an idle driver from the pool, start a new one while the pool is not full
+        """
+        while True:
+            with self.driver_lock:
+                create = self.drivers.empty() and self.driver_count < self.driver_pool_size
+                if create:
+                    self.driver_count += 1
+            if create:
+                break
+            # A discarded driver frees its place, so the waiting is retried
+            try:
+                return self.drivers.get(timeout=1)
+            except queue.Empty:
+                continue
+        try:
+            driver = self.setup_driver()
+        except Exception:
+            with self.driver_lock:
+                self.driver_count -= 1
+            raise
+        with self.driver_lock:
+            self.all_drivers.append(driver)
+        return driver
+
+    def discardDriver(self, driver):
+        """
+        Quit a broken driver and free its place in the pool
+        """
+        with self.driver_lock:
+            if driver not in self.all_drivers:
+                return
+            self.all_drivers.remove(driver)
+            self.driver_count -= 1
+        try:
+            driver.quit()
+        except Exception as e:
+            print(f"Error on closing driver: {e}")
+
+    def closeDrivers(self):
+        """
+        Quit all the drivers started, the idle ones and the ones still searching
+        """
+        # The queued searches are dropped, the running ones fail once their
+        # driver quits, so no thread keeps a browser alive after the run
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        with self.driver_lock:
+            drivers = self.all_drivers
+            self.all_drivers = []
+            self.driver_count = 0
+        while not self.drivers.empty():
+            self.drivers.get_nowait()
+        for driver in drivers:
+            try:
+                driver.quit()
+            except Exception as e:
+                print(f"Error on closing driver: {e}")
+
+    def searchChannel(self, name, pageUrl, resultClass, infoList):
+        """
+        Search the channel with a driver taken from the pool
+        """
+        from selenium.common.exceptions import TimeoutException, WebDriverException
+
+        driver = self.getDriver()
+        try:
+            result = self.searchChannelByDriver(
+                driver, name, pageUrl, resultClass, infoList
+            )
+        except WebDriverException as e:
+            # A timeout is the site being slow, any other driver error means the
+            # browser crashed or hung, so it is replaced instead of reused
+            if isinstance(e, TimeoutException):
+                self.drivers.put(driver)
+            else:
+                self.discardDriver(driver)
+            raise
+        except Exception:
+            self.drivers.put(driver)
+            raise
+        self.drivers.put(driver)
+        return result
 
-    async def visitPage(self, channelItems):
+    def getPageNum(self, name):
+        """
+        Get the number of result pages to search for the channel
+        """
+        settings = getSettings()
+        isFavorite = name in settings.favorite_list
+        return settings.favorite_page_num if isFavorite else settings.default_page_num
+
+    def parseSearchPage(self, name, page, page_source, resultClass, infoList):
+        """
+        Merge the results of the page into the info list, return the next page link
+        """
+        start = time.time()
+        results, links = getSearchResults(page_source, resultClass)
+        if results and results[0]:
+            print("\n", results[0][0])
+        for result in results:
+            try:
+                url, date, resolution, channel_name = getUrlInfo(result)
+                if not channel_name or not self.name_index.matches(name, channel_name):
+                    continue
+                if url and checkUrlByPatterns(url):
+                    infoList.add(url, date, resolution, channel_name)
+            except Exception as e:
+                print(f"Error on result {result}: {e}")
+                continue
+        next_page = None
+        for href in links:
+            if f"page={page+1}" in href and f"{name}" in href:
+                next_page = href
+                break
+        getMetrics().observe("parse", (time.time() - start) * 1000)
+        return next_page
+
+    def searchChannelByDriver(self, driver, name, pageUrl, resultClass, infoList):
+        """
+        Search the channel on the page and merge the results into the info list
+        """
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.common.exceptions import TimeoutException, WebDriverException
+
+        wait = WebDriverWait(driver, 10)
+        start = time.time()
+        driver.get(pageUrl)
+        getMetrics().observe("page_load", (time.time() - start) * 1000)
+        search_box = wait.until(
+            EC.presence_of_element_located(
+                (By.XPATH, '//input[@type="text"]')
+            )
+        )
+        search_box.clear()
+        search_box.send_keys(name)
+        submit_button = wait.until(
+            EC.element_to_be_clickable(
+                (By.XPATH, '//input[@type="submit"]')
+            )
+        )
+
+        def loadPage(element):
+            """
+            Click the element and wait until the next page replaces the current
+            one, only a page that loaded in time is counted in the page_load timing
+            """
+            old_page = driver.find_element(By.TAG_NAME, "html")
+            start = time.time()
+            driver.execute_script("arguments[0].click();", element)
+            try:
+                wait.until(EC.staleness_of(old_page))
+            except TimeoutException:
+                return
+            getMetrics().observe("page_load", (time.time() - start) * 1000)
+
+        loadPage(submit_button)
+        for page in range(1, self.getPageNum(name) + 1):
+            try:
+                if page > 1:
+                    page_link = wait.until(
+                        EC.element_to_be_clickable(
+                            (
+                                By.XPATH,
+                                f'//a[contains(@href, "={page}") and contains(@href, "{name}")]',
+                            )
+                        )
+                    )
+                    loadPage(page_link)
+                if not self.parseSearchPage(
+                    name, page, driver.page_source, resultClass, infoList
+                ):
+                    break
+            except WebDriverException as e:
+                # Only a page that is slow to load is skipped, a broken driver
+                # fails the search so the pool replaces it
+                if not isinstance(e, TimeoutException):
+                    raise
+                print(f"Error on page {page}: {e}")
+                continue
+            except Exception as e:
+                print(f"Error on page {page}: {e}")
+                continue
+        return infoList
+
+    async def searchChannelByHttp(self, name, pageUrl, resultClass, infoList):
+        """
+        Search the channel by submitting the search form over http, without a browser
+        """
+        session = getProbeEngine().getSession()
+        page_source = await fetchSearchPage(session, "get", pageUrl)
+        search_request = getSearchFormRequest(page_source, pageUrl, name)
+        if search_request is None:
+            raise ValueError(f"Search form not found on {pageUrl}")
+        method, url, data = search_request
+        start = time.time()
+        page_source = await fetchSearchPage(session, method, url, data)
+        getMetrics().observe("page_load", (time.time() - start) * 1000)
+        for page in range(1, self.getPageNum(name) + 1):
+            if page > 1:
+                start = time.time()
+                page_source = await fetchSearchPage(session, "get", url)
+                getMetrics().observe("page_load", (time.time() - start) * 1000)
+            page_link = self.parseSearchPage(
+                name, page, page_source, resultClass, infoList
+            )
+            if not page_link:
+                break
+            url = urljoin(url, page_link)
+        return infoList
+
+    async def probeChannel(self, name, infoList, channelUrls, fallbackUrls, probe, pbar):
+        """
+        Sort the channel urls by speed and resolution, fill the channel result
+        """
+        try:
+            if probe:
+                candidates = infoList.toList()
+                sorted_data = await sortUrlsBySpeedAndResolution(list(candidates))
+                if sorted_data:
+                    channelUrls[name] = getTotalUrls(sorted_data)
+                    for (url, date, resolution, channel_name), response_time in sorted_data:
+                        logging.info(
+                            f"Name: {name}, URL_NAME: {channel_name}, URL: {url}, Date: {date}, Resolution: {resolution}, Response Time: {response_time}ms"
+                        )
+                else:
+                    channelUrls[name] = filterUrlsByPatterns(fallbackUrls)
+                self.recordSourceYield(name, candidates, sorted_data, channelUrls[name])
+            else:
+                channelUrls[name] = filterUrlsByPatterns(fallbackUrls)
+        except Exception as e:
+            print(f"Error on sorting: {e}")
+        finally:
+            pbar.update()
+
+    def recordSourceYield(self, name, candidates, sorted_data, urls):
+        """
+        Record the probed candidates and the result urls of the channel to the
+        sources they were found on
+        """
+        registry = getSourceRegistry()
+        if registry is None:
+            return
+        search_url = self.search_sites.get(name)
+        for _, _, _, channel_name in candidates:
+            for source in getCandidateSources(channel_name, search_url):
+                registry.recordProbed(source)
+        urls = set(urls)
+        for (url, _, _, channel_name), _ in sorted_data:
+            if url in urls:
+                for source in getCandidateSources(channel_name, search_url):
+                    registry.recordAlive(source)
+
+    async def processChannel(
+        self, cate, name, channelObj, extendResults, searchSites, probe, pbar
+    ):
+        """
+        Collect the candidates of the channel, search it on the driver pool, then probe
+        """
+        candidates = self.checkpoint.getChannel(cate, name).get("candidates")
+        collectTime = None
+        if candidates is not None:
+            # Collected before the interruption, only the probes are left
+            infoList = ChannelCandidates()
+            for candidate in candidates:
+                infoList.add(*candidate)
+        else:
+            start = time.time()
+            infoList = await self.collectChannel(
+                name, channelObj, extendResults, searchSites
+            )
+            collectTime = time.time() - start
+            self.checkpoint.setCandidates(cate, name, infoList)
+        pbar.set_description(f"Processing {name}")
+        channelUrls = {}
+        start = time.time()
+        await self.probeChannel(
+            name, infoList, channelUrls, channelObj[name], probe, pbar
+        )
+        getMetrics().addChannel(
+            cate,
+            name,
+            collect=collectTime,
+            probe=time.time() - start if probe else None,
+            candidates=len(infoList),
+            urls=len(channelUrls.get(name) or []),
+        )
+        if channelUrls.get(name) is not None:
+            self.checkpoint.setResult(cate, name, channelUrls[name])
+        return channelUrls.get(name)
+
+    async def collectChannel(self, name, channelObj, extendResults, searchSites):
+        """
+        Collect the candidates of the channel from the source file, the extend
+        results and the search sites
+        """
+        infoList = ChannelCandidates()
+        for url in channelObj.get(name, []):
+            if url and checkUrlByPatterns(url):
+                infoList.add(url, None, None, name+"_INIT")
+        for url, date, resolution, channel_name in extendResults.get(name, []):
+            if url and checkUrlByPatterns(url):
+                infoList.add(url, None, resolution, name+"_"+channel_name)
+        if not searchSites:
+            return infoList
+        # The search sites are tried in order until one works for the channel,
+        # the sites that failed in this run last, ordered once a search slot is free
+        async with self.search_semaphore:
+            for pageUrl, resultClass in sorted(
+                searchSites, key=lambda site: self.search_failures.get(site[0], 0)
+            ):
+                try:
+                    result = await self.searchChannelOnSite(
+                        name, pageUrl, resultClass, infoList.copy()
+                    )
+                except Exception as e:
+                    print(f"Error on search {name} on {pageUrl}: {e}")
+                    self.search_failures[pageUrl] = (
+                        self.search_failures.get(pageUrl, 0) + 1
+                    )
+                    continue
+                self.search_sites[name] = pageUrl
+                registry = getSourceRegistry()
+                if registry is not None:
+                    registry.recordFetch(
+                        pageUrl, int(len(result) > len(infoList)), None
+                    )
+                return result
+        return infoList
+
+    async def searchChannelOnSite(self, name, pageUrl, resultClass, infoList):
+        """
+        Search the channel on the site with the search backend, the http search
+        falls back to the driver pool
+        """
+        if self.search_backend == "http":
+            try:
+                return await self.searchChannelByHttp(
+                    name, pageUrl, resultClass, infoList.copy()
+                )
+            except Exception as e:
+                print(f"Error on http search {name}, fallback to selenium: {e}")
+        # The blocking driver runs in the pool threads, so the probes
+        # of the channels already searched keep running meanwhile
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            self.searchChannel,
+            name,
+            pageUrl,
+            resultClass,
+            infoList,
+        )
+
+    async def visitPage(self, channelItems, writer):
+        # The categories written before an interrupted run are skipped
+        allChannelItems = channelItems
+        channelItems = {
+            cate: channelObj
+            for cate, channelObj in channelItems.items()
+            if not writer.isCompleted(cate)
+        }
+        self.name_index = ChannelNameIndex(
+            [name for channelObj in channelItems.values() for name in channelObj.keys()]
+        )
+        manifest = (
+            UpdateManifest(
+                "result_manifest.json"
+                if self.shard is None
+                else getShardPath("result_manifest.json", self.shard[0])
+            ).load()
+            if getSettings().incremental_update
+            else None
+        )
+        # The channels with a fresh result in the manifest are not processed again
+        freshUrls = {}
+        if manifest is not None:
+            for cate, channelObj in channelItems.items():
+                for name in channelObj.keys():
+                    urls = manifest.getFreshUrls(cate, name, channelObj[name])
+                    if urls is not None:
+                        freshUrls[(cate, name)] = urls
+            print(f"Incremental update: {len(freshUrls)} channels are still fresh")
+        # The channels finished before an interruption keep their result
+        for cate, channelObj in channelItems.items():
+            for name in channelObj.keys():
+                urls = self.checkpoint.getChannel(cate, name).get("urls")
+                if urls is not None and (cate, name) not in freshUrls:
+                    freshUrls[(cate, name)] = urls
         channelNames = [
-            name for _, channelObj in channelItems.items() for name in channelObj.keys()
+            name
+            for cate, channelObj in channelItems.items()
+            for name in channelObj.keys()
+            if (cate, name) not in freshUrls
         ]
-        extendResults = await getChannelsByExtendBaseUrls(channelNames)
         total_channels = len(channelNames)
+        collectNames = [
+            name
+            for cate, channelObj in channelItems.items()
+            for name in channelObj.keys()
+            if (cate, name) not in freshUrls
+            and "candidates" not in self.checkpoint.getChannel(cate, name)
+        ]
+        metrics = getMetrics()
+        if collectNames:
+            with metrics.stage("extend"):
+                extendResults = await getChannelsByExtendBaseUrls(
+                    collectNames, self.name_index
+                )
+            with metrics.stage("search_site"):
+                searchSites = await useAccessibleUrl()
+        else:
+            extendResults = {}
+            searchSites = []
+        from tqdm import tqdm
+
         pbar = tqdm(total=total_channels)
-        (pageUrl,resultClass) = await useAccessibleUrl()
-        wait = WebDriverWait(self.driver, 10)
+        self.search_semaphore = asyncio.Semaphore(self.driver_pool_size)
+        github_actions = os.environ.get("GITHUB_ACTIONS")
+        # All channels are scheduled at once, the driver pool bounds the searches
+        # and the probe engine bounds the probes, categories are written in order
+        index = 0
+        cateTasks = []
         for cate, channelObj in channelItems.items():
-            channelUrls = {}
-            channelObjKeys = channelObj.keys()
-            for name in channelObjKeys:
-                pbar.set_description(
-                    f"Processing {name}, {total_channels - pbar.n} channels remaining"
+            tasks = {}
+            for name in channelObj.keys():
+                if (cate, name) in freshUrls:
+                    continue
+                probe = not github_actions or (
+                    index < 200 and github_actions == "true"
                 )
-                infoList = []
-                for url in channelObj.get(name, []):
-                    if url and checkUrlByPatterns(url):
-                        infoList.append((url, None, None, name+"_INIT"))
-                for url, date, resolution, channel_name in extendResults.get(name, []):
-                    if url and checkUrlByPatterns(url):
-                        infoFind = False
-                        for i in range(len(infoList)):
-                            (check_url, _, _, check_name) = infoList[i]
-                            if check_url == url:
-                                infoList[i] = (url, None, resolution, check_name+"|"+name+"_"+channel_name)
-                                infoFind = True
-                                break
-                        if not infoFind:
-                            infoList.append((url, None, resolution, name+"_"+channel_name))
-                if pageUrl:
-                    self.driver.get(pageUrl)
-                    search_box = wait.until(
-                        EC.presence_of_element_located(
-                            (By.XPATH, '//input[@type="text"]')
-                        )
-                    )
-                    search_box.clear()
-                    search_box.send_keys(name)
-                    submit_button = wait.until(
-                        EC.element_to_be_clickable(
-                            (By.XPATH, '//input[@type="submit"]')
-                        )
-                    )
-                    self.driver.execute_script("arguments[0].click();", submit_button)
-                    isFavorite = name in config.favorite_list
-                    pageNum = (
-                        config.favorite_page_num
-                        if isFavorite
-                        else config.default_page_num
+                index += 1
+                tasks[name] = asyncio.create_task(
+                    self.processChannel(
+                        cate, name, channelObj, extendResults, searchSites, probe, pbar
                     )
-                    for page in range(1, pageNum + 1):
-                        try:
-                            if page > 1:
-                                page_link = wait.until(
-                                    EC.element_to_be_clickable(
-                                        (
-                                            By.XPATH,
-                                            f'//a[contains(@href, "={page}") and contains(@href, "{name}")]',
-                                        )
-                                    )
-                                )
-                                self.driver.execute_script(
-                                    "arguments[0].click();", page_link
-                                )
-                            soup = BeautifulSoup(self.driver.page_source, "html.parser")
-                            results = (
-                                soup.find_all("div", class_=resultClass) if soup else []
-                            )
-                            if 0 < len(results):
-                                result_div = [div for div in results[0].children if div.name == "div" and div.get_text(strip=True) and (not div.attrs.get('style') or not 'none' in div.attrs.get('style'))]
-                                if 0 < len(result_div):
-                                    print("\n", result_div[0].get_text(strip=True))
-                            for result in results:
-                                try:
-                                    url, date, resolution, channel_name = getUrlInfo(result)
-                                    if not channel_name or re.match(re.escape(f"{name}")+r"(?![0-9kK+\-])", channel_name, re.IGNORECASE) is None:
-                                        continue
-                                    if url and checkUrlByPatterns(url):
-                                        infoFind = False
-                                        for i in range(len(infoList)):
-                                            (check_url, check_date, check_resolution, check_name) = infoList[i]
-                                            if check_url == url:
-                                                infoList[i] = (url, date if not check_date else check_date, resolution if not check_resolution else check_resolution, check_name+"|"+channel_name)
-                                                infoFind = True
-                                                break
-                                        if not infoFind:
-                                            infoList.append((url, date, resolution, channel_name))
-                                except Exception as e:
-                                    print(f"Error on result {result}: {e}")
-                                    continue
-                            results = (
-                                soup.find_all('a', href=True) if soup else []
-                            )
-                            page_find = False
-                            for result in results:
-                                if f"page={page+1}" in result['href'] and f"{name}" in result['href']:
-                                    page_find = True
-                                    break
-                            if not page_find:
-                                break
-                        except Exception as e:
-                            print(f"Error on page {page}: {e}")
-                            continue
-                try:
-                    github_actions = os.environ.get("GITHUB_ACTIONS")
-                    if not github_actions or (
-                        pbar.n <= 200 and github_actions == "true"
-                    ):
-                        sorted_data = await sortUrlsBySpeedAndResolution(infoList)
-                        if sorted_data:
-                            channelUrls[name] = getTotalUrls(sorted_data)
-                            for (url, date, resolution, channel_name), response_time in sorted_data:
-                                logging.info(
-                                    f"Name: {name}, URL_NAME: {channel_name}, URL: {url}, Date: {date}, Resolution: {resolution}, Response Time: {response_time}ms"
-                                )
-                        else:
-                            channelUrls[name] = filterUrlsByPatterns(channelObj[name])
-                    else:
-                        channelUrls[name] = filterUrlsByPatterns(channelObj[name])
-                except Exception as e:
-                    print(f"Error on sorting: {e}")
-                    continue
-                finally:
-                    pbar.update()
-            updateChannelUrlsTxt(cate, channelUrls)
-            await asyncio.sleep(1)
+                )
+            cateTasks.append((cate, channelObj, tasks))
+        processStart = time.time()
+        for cate, channelObj, tasks in cateTasks:
+            await asyncio.gather(*tasks.values())
+            channelUrls = {}
+            for name in channelObj.keys():
+                if (cate, name) in freshUrls:
+                    channelUrls[name] = freshUrls[(cate, name)]
+                elif tasks[name].result() is not None:
+                    channelUrls[name] = tasks[name].result()
+                    if manifest is not None:
+                        manifest.set(cate, name, channelObj[name], channelUrls[name])
+            with metrics.stage("write"):
+                writer.write(cate, channelUrls)
+                self.checkpoint.save()
+        metrics.addStage("process", time.time() - processStart)
         pbar.close()
+        if manifest is not None:
+            manifest.save(allChannelItems)
+
+    async def run(self, resume=False):
+        writer = ResultWriter(
+            f"{self.run_name}.txt",
+            f"{self.run_name}.m3u",
+            f"{self.run_name}.checkpoint.json",
+        ).open(resume)
+        self.checkpoint = RunCheckpoint(f"{self.run_name}.progress.json")
+        if resume:
+            self.checkpoint.load()
+        with getMetrics().stage("source"):
+            channelItems = getChannelItems()
+        if self.shard is not None:
+            channelItems = getShardChannelItems(channelItems, *self.shard)
+        # The shard count is only recorded once the shard has finished, a stale
+        # record of an earlier run must not let an unfinished shard be merged
+        shard_info = f"{self.run_name}.json"
+        if self.shard is not None and os.path.exists(shard_info):
+            os.remove(shard_info)
+        finished = False
+        try:
+            await self.visitPage(channelItems, writer)
+            finished = True
+        finally:
+            writer.close(finished)
+            if finished:
+                self.checkpoint.remove()
+                if self.shard is not None:
+                    saveJsonAtomic(
+                        shard_info,
+                        {"index": self.shard[0], "count": self.shard[1]},
+                        "shard info",
+                    )
+            else:
+                self.checkpoint.save()
+            logProbeHostStats()
+            writeRunMetrics(getSettings().metrics_file)
+            await closeProbeEngine()
+            saveProbeCache()
+            saveSourceRegistry(finished)
+            self.closeDrivers()
 
-    def main(self):
-        asyncio.run(self.visitPage(getChannelItems()))
+    def closeLogging(self):
         for handler in logging.root.handlers[:]:
             handler.close()
             logging.root.removeHandler(handler)
-        user_final_file = getattr(config, "final_file", "result.txt")
+
+    def updateFinalFiles(self):
+        user_final_file = getSettings().final_file
         user_log_file = (
             "user_result.log" if os.path.exists("user_config.py") else "result.log"
         )
         updateFile(user_final_file, "result_new.txt")
+        updateFile(os.path.splitext(user_final_file)[0] + ".m3u", "result_new.m3u")
         updateFile(user_log_file, "result_new.log")
         print(f"Update completed! Please check the {user_final_file} file!")
 
+    def main(self, resume=False):
+        setupLogging(f"{self.run_name}.log")
+        asyncio.run(self.run(resume))
+        self.closeLogging()
+        print(getMetrics().getSummary())
+        if self.shard is not None:
+            print(
+                f"Shard {self.shard[0]}/{self.shard[1]} completed! Please merge the shards with --merge {self.shard[1]}"
+            )
+            return
+        self.updateFinalFiles()
+
+    def merge(self, count):
+        """
+        Merge the partial results of the shards in the order of the source file,
+        the final file is left untouched unless all the shards of a run split
+        into count shards have finished
+        """
+        incomplete = []
+        for index in range(1, count + 1):
+            info = loadJson(f"result_shard{index}.json", "shard info", {})
+            if (
+                not isinstance(info, dict)
+                or info.get("count") != count
+                or not os.path.exists(f"result_shard{index}.txt")
+                or os.path.exists(f"result_shard{index}.checkpoint.json")
+            ):
+                incomplete.append(index)
+        if incomplete:
+            print(
+                f"Merge aborted, missing or unfinished shards of {count}: {', '.join(map(str, incomplete))}"
+            )
+            return False
+        shard_pattern = re.compile(r"result_shard(\d+)\.txt$")
+        extra = sorted(
+            int(match.group(1))
+            for match in map(shard_pattern.match, os.listdir("."))
+            if match and int(match.group(1)) > count
+        )
+        if extra:
+            print(
+                f"Merge aborted, shards beyond the count {count} found: {', '.join(map(str, extra))}"
+            )
+            return False
+        shardItems = {}
+        for index in range(1, count + 1):
+            shard_file = f"result_shard{index}.txt"
+            for cate, channelObj in getChannelItemsByFile(shard_file).items():
+                for name, urls in channelObj.items():
+                    shardItems[(cate, name)] = [url for url in urls if url]
+        writer = ResultWriter().open()
+        for cate, channelObj in getChannelItems().items():
+            writer.write(
+                cate,
+                {
+                    name: shardItems[(cate, name)]
+                    for name in channelObj.keys()
+                    if (cate, name) in shardItems
+                },
+            )
+        writer.close()
+        for index in range(1, count + 1):
+            for shard_file in (
+                f"result_shard{index}.txt",
+                f"result_shard{index}.m3u",
+                f"result_shard{index}.json",
+            ):
+                if os.path.exists(shard_file):
+                    os.remove(shard_file)
+        with open("result_new.log", "w", encoding="utf-8") as log:
+            for index in range(1, count + 1):
+                shard_log = f"result_shard{index}.log"
+                if os.path.exists(shard_log):
+                    with open(shard_log, "r", encoding="utf-8") as f:
+                        log.write(f.read())
+                    os.remove(shard_log)
+        self.updateFinalFiles()
+        return True
+
+
+def parseShard(value):
+    """
+    Parse the shard argument INDEX/COUNT, the index starts from 1
+    """
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must be INDEX/COUNT, such as 1/4")
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("shard index must be between 1 and COUNT")
+    return index, count
+
+
+def parseShardCount(value):
+    """
+    Parse the merge argument COUNT, the number of shards of the run
+    """
+    try:
+        count = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard count must be an integer")
+    if count < 1:
+        raise argparse.ArgumentTypeError("shard count must be at least 1")
+    return count
+
 
-UpdateSource().main()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update the channel interfaces")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume the interrupted run from its last checkpoint",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parseShard,
+        metavar="INDEX/COUNT",
+        help="Only process the channels of this shard, such as 1/4",
+    )
+    parser.add_argument(
+        "--merge",
+        type=parseShardCount,
+        metavar="COUNT",
+        help="Merge the results of COUNT shards into the final file",
+    )
+    args = parser.parse_args()
+    if args.merge is not None:
+        if not UpdateSource().merge(args.merge):
+            raise SystemExit(1)
+    else:
+        UpdateSource(shard=args.shard).main(resume=args.resume)
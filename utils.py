@@ -5,34 +5,176 @@ except ImportError:
 import aiohttp
 import asyncio
 import time
+import math
 import re
 import datetime
 import os
 import urllib.parse
 import ipaddress
+import hashlib
+import logging
+import threading
+import contextlib
 from urllib.parse import urlparse
-import requests
 import re
+import json
+from collections import OrderedDict, deque
+from functools import lru_cache
+from array import array
+from types import MappingProxyType
+from html.parser import HTMLParser
+
+# The defaults of the config items missing from the config file
+default_settings = {
+    "source_file": "demo.txt",
+    "final_file": "result.txt",
+    "favorite_list": [],
+    "favorite_page_num": 5,
+    "default_page_num": 3,
+    "urls_limit": 10,
+    "response_time_weight": 0.5,
+    "resolution_weight": 0.5,
+    "recent_days": 60,
+    "ipv_type": "ipv4",
+    "domain_blacklist": [],
+    "url_keywords_blacklist": [],
+    "extend_base_urls": [],
+    "probe_concurrency": 50,
+    "probe_per_host": 4,
+    "probe_cache_file": "probe_cache.json",
+    "probe_cache_ttl": 6,
+    "probe_cache_negative_ttl": 1,
+    "probe_cache_size": 20000,
+    "driver_pool_size": 1,
+    "search_backend": "selenium",
+    "extend_cache_file": "extend_cache.json",
+    "probe_stream": False,
+    "probe_segment_bytes": 512 * 1024,
+    "probe_segment_timeout": 5,
+    "speed_weight": 0,
+    "probe_adaptive": False,
+    "probe_host_fail_threshold": 3,
+    "incremental_update": False,
+    "incremental_window": 24,
+    "checkpoint_interval": 60,
+    "channel_alias": {},
+    "metrics_file": "",
+    "search_urls": ["http://www.foodieguide.com/iptvsearch/", "http://tonkiang.us/"],
+    "source_registry_file": "source_registry.json",
+    "source_skip_runs": 3,
+    "source_max_latency": 20000,
+}
+
+
+def freezeSetting(value):
+    """
+    Get a read only copy of the config value
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(freezeSetting(item) for item in value)
+    if isinstance(value, dict):
+        return MappingProxyType({key: freezeSetting(item) for key, item in value.items()})
+    return value
+
+
+# The state files saved during the run, each shard keeps its own
+shard_state_settings = (
+    "probe_cache_file",
+    "extend_cache_file",
+    "source_registry_file",
+    "metrics_file",
+)
+
+
+def getShardPath(path, index):
+    """
+    Get the path of the file for the shard index
+    """
+    root, ext = os.path.splitext(path)
+    return f"{root}_shard{index}{ext}"
+
+
+class Settings:
+    """
+    Read only snapshot of the config with the defaults filled in, read once per run
+    """
+
+    __slots__ = ("values",)
+
+    def __init__(self, module=None, shard=None):
+        module = module or config
+        values = {
+            key: freezeSetting(getattr(module, key, default))
+            for key, default in default_settings.items()
+        }
+        if shard is not None:
+            # Shards may run side by side, they must not save the same files
+            for key in shard_state_settings:
+                if values[key]:
+                    values[key] = getShardPath(values[key], shard[0])
+        object.__setattr__(self, "values", MappingProxyType(values))
+
+    def __getattr__(self, key):
+        try:
+            return self.values[key]
+        except KeyError:
+            raise AttributeError(f"Unknown config item: {key}") from None
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Settings are read only")
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+
+settings = None
+
+
+def getSettings():
+    """
+    Get the settings of the run, read from the config on first use
+    """
+    global settings
+    if settings is None:
+        settings = Settings()
+    return settings
+
+
+def loadSettings(module=None, shard=None):
+    """
+    Read the settings again, after the config has been changed in place or
+    for a shard (index, count)
+    """
+    global settings
+    settings = Settings(module, shard)
+    return settings
 
 
 def getChannelItems():
     """
     Get the channel items from the source file
     """
-    # Open the source file and read all lines.
+    source_file = getSettings().source_file
+    user_source_file = (
+        "user_" + source_file
+        if os.path.exists("user_" + source_file)
+        else source_file
+    )
+    return getChannelItemsByFile(user_source_file)
+
+
+def getChannelItemsByFile(file):
+    """
+    Get the channel items from a file in the source file format
+    """
+    # Open the file and read all lines.
     try:
-        user_source_file = (
-            "user_" + config.source_file
-            if os.path.exists("user_" + config.source_file)
-            else getattr(config, "source_file", "demo.txt")
-        )
-        with open(user_source_file, "r", encoding="utf-8") as f:
+        with open(file, "r", encoding="utf-8") as f:
             lines = f.readlines()
 
         # Create a dictionary to store the channels.
         channels = {}
         current_category = ""
-        pattern = r"^(.*?),(?!#genre#)(.*?)$"
 
         for line in lines:
             line = line.strip()
@@ -42,7 +184,7 @@ def getChannelItems():
                 channels[current_category] = {}
             else:
                 # This is a url, add it to the list of urls for the current channel.
-                match = re.search(pattern, line)
+                match = channel_line_pattern.search(line)
                 if match is not None:
                     if match.group(1) not in channels[current_category]:
                         channels[current_category][match.group(1)] = [match.group(2)]
@@ -59,83 +201,868 @@ def getChannelItems():
         f.close()
 
 
-async def getChannelsByExtendBaseUrls(channel_names):
+def getShardChannelItems(channelItems, index, count):
     """
-    Get the channels by extending the base urls
+    Get the channel items of the shard, the channels are assigned to the shards
+    in turn by their order in the source file, the index starts from 1
+    """
+    shardItems = {}
+    position = 0
+    for cate, channelObj in channelItems.items():
+        shardObj = {}
+        for name, urls in channelObj.items():
+            if position % count == index - 1:
+                shardObj[name] = urls
+            position += 1
+        if shardObj:
+            shardItems[cate] = shardObj
+    return shardItems
+
+
+channel_line_pattern = re.compile(r"^(.*?),(?!#genre#)(.*?)$")
+channel_sub_pattern = re.compile(r"_\((.*?)\)|_\[(.*?)\]|频道")
+channel_suffix_pattern = re.compile(r"(?<=.)(高清|超清|标清|fhd|hd)$")
+extend_resolution_pattern = re.compile(r"_(\((.*?)\))")
+default_channel_alias = {"cctv5plus":"cctv5+","旅游卫视":"海南卫视","卡酷动画":"卡酷少儿","北京卡酷少儿":"卡酷少儿",
+                         "上海五星体育":"五星体育","newtv超级体育":"超级体育","newtv精品体育":"精品体育"}
+
+
+@lru_cache(maxsize=None)
+def normalizeChannelName(name):
+    """
+    Normalize the channel name: drop the _(...) and _[...] suffixes, "频道",
+    the text after a space, hyphens and the definition suffix, in lower case
+    """
+    key = channel_sub_pattern.sub("", name).strip().lower()
+    key = key.partition(" ")[0].replace("-", "")
+    return channel_suffix_pattern.sub("", key)
+
+
+class ChannelNameIndex:
+    """
+    Index of the source file channel names by their normalized name, built once
+    per run to resolve the names found in the m3u, txt and search results
+    """
+
+    def __init__(self, channel_names, alias=None):
+        if alias is None:
+            alias = getSettings().channel_alias
+        self.alias = {
+            normalizeChannelName(key): normalizeChannelName(value)
+            for key, value in {**default_channel_alias, **alias}.items()
+        }
+        self.channels = {}
+        for name in channel_names:
+            names = self.channels.setdefault(self.getKey(name), [])
+            if name not in names:
+                names.append(name)
+        self.prefix_patterns = {}
+
+    def getKey(self, name):
+        """
+        Get the index key of the channel name
+        """
+        key = normalizeChannelName(name)
+        return self.alias.get(key, key)
+
+    def resolveKey(self, key):
+        """
+        Get the channel names of the normalized name
+        """
+        return self.channels.get(self.alias.get(key, key), [])
+
+    def resolve(self, name):
+        """
+        Get the channel names the name refers to
+        """
+        return self.resolveKey(normalizeChannelName(name))
+
+    def matches(self, name, result_name):
+        """
+        Check if the search result name refers to the channel: the same normalized
+        name, or the channel name followed by anything but a digit, k, + or -
+        """
+        if name in self.resolve(result_name):
+            return True
+        pattern = self.prefix_patterns.get(name)
+        if pattern is None:
+            pattern = self.prefix_patterns[name] = re.compile(
+                re.escape(name) + r"(?![0-9kK+\-])", re.IGNORECASE
+            )
+        return pattern.match(result_name) is not None
+
+
+@lru_cache(maxsize=None)
+def getExtendKey(name):
+    """
+    Get the normalized index key and resolution of the extend channel name
+    """
+    resolution_match = extend_resolution_pattern.search(name)
+    resolution = resolution_match.group(2) if resolution_match is not None else None
+    return normalizeChannelName(name), resolution
+
+
+def loadJson(path, label, default=None):
+    """
+    Load the json file of the run state, the default if missing or unreadable
+    """
+    if not path or not os.path.exists(path):
+        return default
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error on loading {label}: {e}")
+        return default
+
+
+def writeFileAtomic(path, text, label, sync=False):
+    """
+    Write the file through a tmp file replaced at once, so it is never left half
+    written. A failed write only prints the error, the run state is best effort
+    and must not fail the run: return whether the file was written
+    """
+    if not path:
+        return False
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return True
+    except OSError as e:
+        print(f"Error on saving {label}: {e}")
+        return False
+
+
+def saveJsonAtomic(path, data, label, sync=False):
+    """
+    Save the json file of the run state atomically, see writeFileAtomic
+    """
+    return writeFileAtomic(path, json.dumps(data, ensure_ascii=False), label, sync)
+
+
+# Bump when the extend line parsing or key normalization changes,
+# so the indexes cached by older versions are parsed again
+extend_index_version = 2
+
+
+class ExtendSourceCache:
+    """
+    Http validators and parsed index of the extend base urls, for conditional requests
+    """
+
+    def __init__(self, path=None):
+        self.path = (
+            path
+            if path is not None
+            else getSettings().extend_cache_file
+        )
+        self.entries = {}
+
+    def load(self):
+        """
+        Load the cache file
+        """
+        self.entries = loadJson(self.path, "extend cache", {})
+        return self
+
+    def save(self):
+        """
+        Save the cache file
+        """
+        saveJsonAtomic(self.path, self.entries, "extend cache")
+
+    def get(self, url):
+        """
+        Get the cached entry of the url, None if missing or outdated
+        """
+        entry = self.entries.get(url)
+        if entry is None or entry.get("version") != extend_index_version:
+            return None
+        return entry
+
+    def set(self, url, etag, last_modified, link_dict):
+        """
+        Set the validators and parsed index of the url
+        """
+        if not self.path:
+            return
+        if not etag and not last_modified:
+            self.entries.pop(url, None)
+            return
+        self.entries[url] = {
+            "version": extend_index_version,
+            "etag": etag,
+            "last_modified": last_modified,
+            "index": link_dict,
+        }
+
+
+async def getExtendBaseUrlIndex(session, base_url, cache):
+    """
+    Stream the extend base url and index its lines by the normalized channel name,
+    reuse the cached index when the source is not modified
     """
-    channels = {}
     headers = {"User-Agent": "okhttp/3.15"}
-    pattern = r"^(.*?),(?!#genre#)(.*?)$"
-    sub_pattern = r"_\((.*?)\)|_\[(.*?)\]|频道"
-    key_conv = {"cctv-1":"cctv1","cctv-2":"cctv2","cctv-3":"cctv3","cctv-4":"cctv4","cctv-5":"cctv5","cctv-5+":"cctv5+",
-                "cctv-6":"cctv6","cctv-7":"cctv7","cctv-8":"cctv8","cctv-9":"cctv9","cctv-10":"cctv10","cctv-11":"cctv11",
-                "cctv-12":"cctv12","cctv-13":"cctv13","cctv-14":"cctv14","cctv-15":"cctv15","cctv-16":"cctv16","cctv-17":"cctv17",
-                "cctv-4k":"cctv4k","cctv-8k":"cctv8k","cctv5plus":"cctv5+","旅游卫视":"海南卫视","卡酷动画":"卡酷少儿","北京卡酷少儿":"卡酷少儿",
-                "上海五星体育":"五星体育","newtv超级体育":"超级体育","newtv精品体育":"精品体育"}
-    for base_url in config.extend_base_urls:
-        try:
-            base_index = config.extend_base_urls.index(base_url)
-            print(f"Processing extend base url: {base_url}")
-            try:
-                response = requests.get(base_url, headers=headers, timeout=30)
-            except requests.exceptions.Timeout:
-                print(f"Timeout on {base_url}")
+    entry = cache.get(base_url)
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    link_dict = {}
+    print(f"Processing extend base url: {base_url}")
+    async with session.get(
+        base_url,
+        headers=headers,
+        timeout=aiohttp.ClientTimeout(sock_connect=30, sock_read=30),
+    ) as response:
+        if response.status == 304 and entry is not None:
+            print(f"Not modified: {base_url}")
+            getMetrics().count("cache", cache="extend", result="hit")
+            return entry["index"]
+        getMetrics().count("cache", cache="extend", result="miss")
+        async for line in response.content:
+            match = channel_line_pattern.match(
+                line.decode("utf-8", errors="ignore").rstrip("\r\n")
+            )
+            if match is None:
                 continue
-            content = response.text
-            if content:
-                lines = content.split("\n")
-                link_dict = {}
-                for line in lines:
-                    if re.match(pattern, line) is not None:
-                        key = re.match(pattern, line).group(1)
-                        resolution_match = re.search(r"_(\((.*?)\))", key)
-                        resolution = (
-                            resolution_match.group(2)
-                            if resolution_match is not None
-                            else None
-                        )
-                        key = re.sub(sub_pattern, "", key).lower()
-                        key = key.partition(" ")[0]
-                        key = key_conv.get(key, key).lower()
-                        url = re.match(pattern, line).group(2)
-                        value = (url, None, resolution, f"EXTEND{base_index+1}")
-                        if key in link_dict:
-                            link_dict[key].append(value)
-                        else:
-                            link_dict[key] = [value]
-                found_channels = []
-                for channel_name in channel_names:
-                    sub_channel_name = re.sub(sub_pattern, "", channel_name).lower()
-                    values = link_dict.get(sub_channel_name)
-                    if values:
-                        if channel_name in channels:
-                            channels[channel_name] += values
-                        else:
-                            channels[channel_name] = values
-                        found_channels.append(channel_name)
-                if found_channels:
-                    print(f"{base_url} found channels: {','.join(found_channels)}")
-        except Exception as e:
-            print(f"Error on {base_url}: {e}")
+            key, resolution = getExtendKey(match.group(1))
+            value = (match.group(2), resolution)
+            if key in link_dict:
+                link_dict[key].append(value)
+            else:
+                link_dict[key] = [value]
+        if response.status == 200:
+            cache.set(
+                base_url,
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+                link_dict,
+            )
+    return link_dict
+
+
+class SourceRegistry:
+    """
+    Yield of the extend base urls and search sites across runs: the channels found,
+    the urls that passed probing and the fetch latency of each source
+    """
+
+    def __init__(self, path=None, skip_runs=None, max_latency=None):
+        self.path = path if path is not None else getSettings().source_registry_file
+        self.skip_runs = (
+            skip_runs if skip_runs is not None else getSettings().source_skip_runs
+        )
+        self.max_latency = (
+            max_latency
+            if max_latency is not None
+            else getSettings().source_max_latency
+        )
+        self.entries = {}
+        # The yield of this run, by source url
+        self.run = {}
+
+    def load(self):
+        """
+        Load the registry file
+        """
+        self.entries = loadJson(self.path, "source registry", {})
+        return self
+
+    def save(self):
+        """
+        Save the registry file
+        """
+        saveJsonAtomic(self.path, self.entries, "source registry")
+
+    def getEntry(self, url):
+        return self.entries.get(url) or {
+            "runs": 0,
+            "value": None,
+            "channels": 0,
+            "latency": None,
+            "streak": 0,
+            "skipped": 0,
+        }
+
+    def getRun(self, url):
+        run = self.run.get(url)
+        if run is None:
+            run = self.run[url] = {
+                "channels": 0,
+                "probed": 0,
+                "alive": 0,
+                "latency": None,
+                "failed": False,
+            }
+        return run
+
+    def isSlow(self, url):
+        """
+        Check if the average fetch latency of the source is over the limit
+        """
+        latency = self.getEntry(url)["latency"]
+        return latency is not None and 0 < self.max_latency < latency
+
+    def isUseless(self, url):
+        """
+        Check if none of the urls of the source passed probing in the last runs,
+        or if the source is persistently slow
+        """
+        return 0 < self.skip_runs <= self.getEntry(url)["streak"] or self.isSlow(url)
+
+    def isSkipped(self, url):
+        """
+        Check if the source is skipped in this run, a useless source is tried
+        again once it has been skipped as many runs
+        """
+        return self.isUseless(url) and self.getEntry(url)["skipped"] < self.skip_runs
+
+    def order(self, urls):
+        """
+        Sort the sources by their past value per second of fetch, the ones
+        without history first. Fetches under a second count as one second, so
+        the fast sources are still ranked by their value
+        """
+
+        def key(url):
+            entry = self.getEntry(url)
+            value = entry["value"]
+            if value is None:
+                return (False, 0)
+            return (True, -value * 1000 / max(entry["latency"] or 0, 1000))
+
+        return sorted(urls, key=key)
+
+    def recordFetch(self, url, channels, latency):
+        """
+        Record the channels found and the fetch latency (ms) of the source
+        """
+        run = self.getRun(url)
+        run["channels"] += channels
+        if latency is not None:
+            run["latency"] = latency
+
+    def recordFailure(self, url):
+        """
+        Record a failed fetch of the source
+        """
+        self.getRun(url)["failed"] = True
+
+    def recordProbed(self, url, count=1):
+        """
+        Record the urls of the source probed in this process
+        """
+        self.getRun(url)["probed"] += count
+
+    def recordAlive(self, url, count=1):
+        """
+        Record the urls of the source that passed probing into the results
+        """
+        self.getRun(url)["alive"] += count
+
+    def finishRun(self, urls):
+        """
+        Update the history of the sources with the yield of the finished run,
+        the skipped sources count their skipped runs. The value and the streak
+        only change when urls of the source were probed or its fetch failed, so
+        a partial run (incremental, resumed, sharded or capped) judges nothing
+        """
+        for url in urls:
+            entry = self.getEntry(url)
+            run = self.run.get(url)
+            if run is None:
+                if self.isSkipped(url):
+                    entry["skipped"] += 1
+                    self.entries[url] = entry
+                continue
+            if run["probed"] or run["failed"]:
+                entry["value"] = (
+                    run["alive"]
+                    if entry["value"] is None
+                    else round(entry["value"] * 0.5 + run["alive"] * 0.5, 2)
+                )
+                entry["streak"] = 0 if run["alive"] else entry["streak"] + 1
+            entry["channels"] = run["channels"]
+            if run["latency"] is not None:
+                entry["latency"] = (
+                    run["latency"]
+                    if entry["latency"] is None
+                    else int(entry["latency"] * 0.5 + run["latency"] * 0.5)
+                )
+            entry["skipped"] = 0
+            entry["runs"] += 1
+            entry["updated"] = time.time()
+            self.entries[url] = entry
+        self.run = {}
+
+
+source_registry = None
+
+
+def getSourceRegistry():
+    """
+    Get the process-wide source registry, None if disabled
+    """
+    global source_registry
+    if source_registry is None and getSettings().source_registry_file:
+        source_registry = SourceRegistry().load()
+    return source_registry
+
+
+def saveSourceRegistry(finished=False):
+    """
+    Save the process-wide source registry, a finished run updates the history
+    """
+    if source_registry is None:
+        return
+    if finished:
+        settings = getSettings()
+        source_registry.finishRun([*settings.extend_base_urls, *settings.search_urls])
+    source_registry.save()
+
+
+extend_label_pattern = re.compile(r"_EXTEND(\d+)$")
+
+
+def getCandidateSources(channel_name, search_url=None):
+    """
+    Get the source urls of the merged candidate names: the extend base url of the
+    EXTEND labels, the search site of the other results, nothing for the source file
+    """
+    base_urls = getSettings().extend_base_urls
+    sources = set()
+    for name in channel_name.split("|"):
+        if name.endswith("_INIT"):
+            continue
+        match = extend_label_pattern.search(name)
+        if match is None:
+            if search_url:
+                sources.add(search_url)
+        elif int(match.group(1)) <= len(base_urls):
+            sources.add(base_urls[int(match.group(1)) - 1])
+    return sources
+
+
+async def getExtendBaseUrlTimedIndex(session, base_url, cache):
+    """
+    Get the index of the extend base url and its fetch time (ms)
+    """
+    start = time.time()
+    link_dict = await getExtendBaseUrlIndex(session, base_url, cache)
+    return link_dict, int(round((time.time() - start) * 1000))
+
+
+async def getChannelsByExtendBaseUrls(channel_names, name_index=None):
+    """
+    Get the channels by extending the base urls
+    """
+    if name_index is None:
+        name_index = ChannelNameIndex(channel_names)
+    requested_names = set(channel_names)
+    session = getProbeEngine().getSession()
+    cache = ExtendSourceCache().load()
+    registry = getSourceRegistry()
+    base_urls = getSettings().extend_base_urls
+    # The most valuable sources come first, the useless ones are skipped for a while
+    fetch_urls = list(base_urls)
+    if registry is not None:
+        for base_url in fetch_urls:
+            if registry.isSkipped(base_url):
+                reason = (
+                    "too slow to fetch"
+                    if registry.isSlow(base_url)
+                    else "no interface passed probing in the last runs"
+                )
+                print(f"Skip {base_url}: {reason}")
+        fetch_urls = [
+            base_url
+            for base_url in registry.order(fetch_urls)
+            if not registry.isSkipped(base_url)
+        ]
+    results = await asyncio.gather(
+        *(
+            getExtendBaseUrlTimedIndex(session, base_url, cache)
+            for base_url in fetch_urls
+        ),
+        return_exceptions=True,
+    )
+    cache.entries = {
+        url: entry for url, entry in cache.entries.items() if url in base_urls
+    }
+    cache.save()
+    # Resolve the indexes to the channels in the order of the fetched urls
+    channels = {}
+    for base_url, result in zip(fetch_urls, results):
+        if isinstance(result, asyncio.TimeoutError):
+            print(f"Timeout on {base_url}")
+            if registry is not None:
+                registry.recordFailure(base_url)
+            continue
+        if isinstance(result, Exception):
+            print(f"Error on {base_url}: {result}")
+            if registry is not None:
+                registry.recordFailure(base_url)
             continue
+        link_dict, latency = result
+        # The label keeps the position in the config, whatever the fetch order
+        source_name = f"EXTEND{base_urls.index(base_url)+1}"
+        # A dict keeps the channels in the order found, with constant time lookups
+        found_channels = {}
+        for key, values in link_dict.items():
+            for channel_name in name_index.resolveKey(key):
+                if channel_name not in requested_names:
+                    continue
+                if channel_name not in channels:
+                    channels[channel_name] = []
+                found_channels[channel_name] = True
+                channels[channel_name] += [
+                    (url, None, resolution, source_name) for url, resolution in values
+                ]
+        if found_channels:
+            print(f"{base_url} found channels: {','.join(found_channels)}")
+        if registry is not None:
+            registry.recordFetch(base_url, len(found_channels), latency)
     print("Finished processing extend base urls")
     return channels
 
 
-def updateChannelUrlsTxt(cate, channelUrls):
+class ChannelCandidates:
     """
-    Update the category and channel urls to the final file
+    Candidate urls of a channel indexed by url, merged on insert in insertion order
+    """
+
+    __slots__ = ("items",)
+
+    def __init__(self):
+        # url -> [date, resolution, [names]]
+        self.items = {}
+
+    def add(self, url, date, resolution, name):
+        """
+        Add the candidate, fill the missing date and resolution of a known url
+        and join its names
+        """
+        item = self.items.get(url)
+        if item is None:
+            self.items[url] = [date, resolution, [name]]
+            return
+        if not item[0]:
+            item[0] = date
+        if not item[1]:
+            item[1] = resolution
+        item[2].append(name)
+
+    def copy(self):
+        """
+        Copy the candidates
+        """
+        candidates = ChannelCandidates()
+        candidates.items = {
+            url: [date, resolution, list(names)]
+            for url, (date, resolution, names) in self.items.items()
+        }
+        return candidates
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        for url, (date, resolution, names) in self.items.items():
+            yield url, date, resolution, "|".join(names)
+
+    def toList(self):
+        """
+        Get the candidates as (url, date, resolution, channel_name) tuples
+        """
+        return list(self)
+
+
+class UpdateManifest:
+    """
+    Results of the last runs per channel, for the incremental update
     """
-    try:
-        with open("result_new.txt", "a", encoding="utf-8") as f:
-            f.write(cate + ",#genre#\n")
-            for name, urls in channelUrls.items():
-                for url in urls:
-                    if url is not None:
-                        f.write(name + "," + url + "\n")
-            f.write("\n")
-    finally:
-        f.close
+
+    def __init__(self, path="result_manifest.json", window=None):
+        self.path = path
+        self.window = (
+            window
+            if window is not None
+            else getSettings().incremental_window
+        ) * 3600
+        self.fingerprint = getConfigFingerprint()
+        self.channels = {}
+
+    def load(self):
+        """
+        Load the manifest, the channels are dropped if the config changed
+        """
+        data = loadJson(self.path, "manifest", {})
+        if data.get("config") == self.fingerprint:
+            self.channels = data.get("channels", {})
+        return self
+
+    def save(self, channelItems):
+        """
+        Save the manifest, only the channels still in the source file are kept
+        """
+        channels = {}
+        for cate, channelObj in channelItems.items():
+            for name in channelObj.keys():
+                entry = self.channels.get(cate, {}).get(name)
+                if entry is not None:
+                    channels.setdefault(cate, {})[name] = entry
+        saveJsonAtomic(
+            self.path, {"config": self.fingerprint, "channels": channels}, "manifest"
+        )
+
+    def getFreshUrls(self, cate, name, urls):
+        """
+        Get the last result of the channel if its source urls are unchanged
+        and it is within the freshness window, otherwise None
+        """
+        entry = self.channels.get(cate, {}).get(name)
+        if (
+            entry is None
+            or entry.get("hash") != getChannelHash(urls)
+            or time.time() - entry.get("time", 0) >= self.window
+        ):
+            return None
+        return entry.get("urls")
+
+    def set(self, cate, name, urls, result):
+        """
+        Set the result of the channel
+        """
+        self.channels.setdefault(cate, {})[name] = {
+            "hash": getChannelHash(urls),
+            "time": time.time(),
+            "urls": result,
+        }
+
+
+def getChannelHash(urls):
+    """
+    Get the hash of the channel source urls
+    """
+    return hashlib.sha1("\n".join(urls).encode("utf-8")).hexdigest()
+
+
+def getConfigFingerprint():
+    """
+    Get the fingerprint of the config items that affect the results
+    """
+    keys = [
+        "favorite_list",
+        "favorite_page_num",
+        "default_page_num",
+        "urls_limit",
+        "response_time_weight",
+        "resolution_weight",
+        "speed_weight",
+        "recent_days",
+        "ipv_type",
+        "domain_blacklist",
+        "url_keywords_blacklist",
+        "extend_base_urls",
+        "probe_stream",
+        "channel_alias",
+        "search_urls",
+    ]
+    settings = getSettings()
+    data = json.dumps(
+        {
+            key: (
+                dict(settings.get(key))
+                if isinstance(settings.get(key), MappingProxyType)
+                else settings.get(key)
+            )
+            for key in keys
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+class ResultWriter:
+    """
+    Result sink opened once for the run. The categories are streamed to the txt
+    and m3u results as they finish, each one synced to disk and recorded in
+    a checkpoint, so an interrupted run can resume after the last category written
+    """
+
+    def __init__(
+        self,
+        txt_path="result_new.txt",
+        m3u_path="result_new.m3u",
+        checkpoint_path="result_new.checkpoint.json",
+    ):
+        self.txt_path = txt_path
+        self.m3u_path = m3u_path
+        self.checkpoint_path = checkpoint_path
+        self.completed = []
+        self.txt_file = None
+        self.m3u_file = None
+
+    def open(self, resume=False):
+        """
+        Open the results, continue after the checkpoint when resuming
+        """
+        checkpoint = self.loadCheckpoint() if resume else None
+        if checkpoint is not None:
+            # Drop anything written after the last checkpoint
+            os.truncate(self.txt_path, checkpoint["txt_offset"])
+            os.truncate(self.m3u_path, checkpoint["m3u_offset"])
+            self.completed = checkpoint["completed"]
+            self.txt_file = open(self.txt_path, "a", encoding="utf-8")
+            self.m3u_file = open(self.m3u_path, "a", encoding="utf-8")
+            print(f"Resume after {len(self.completed)} completed categories")
+        else:
+            self.completed = []
+            self.txt_file = open(self.txt_path, "w", encoding="utf-8")
+            self.m3u_file = open(self.m3u_path, "w", encoding="utf-8")
+            self.m3u_file.write("#EXTM3U\n")
+            self.sync()
+        return self
+
+    def loadCheckpoint(self):
+        """
+        Load the checkpoint, None if missing or it does not match the results
+        """
+        checkpoint = loadJson(self.checkpoint_path, "checkpoint")
+        if checkpoint is None:
+            return None
+        try:
+            if (
+                os.path.getsize(self.txt_path) < checkpoint["txt_offset"]
+                or os.path.getsize(self.m3u_path) < checkpoint["m3u_offset"]
+            ):
+                return None
+            return checkpoint
+        except (OSError, TypeError, KeyError) as e:
+            print(f"Error on loading checkpoint: {e}")
+            return None
+
+    def isCompleted(self, cate):
+        """
+        Check if the category is already written
+        """
+        return cate in self.completed
+
+    def write(self, cate, channelUrls):
+        """
+        Write the category and channel urls to the results
+        """
+        self.txt_file.write(cate + ",#genre#\n")
+        for name, urls in channelUrls.items():
+            for url in urls:
+                if url is not None:
+                    self.txt_file.write(name + "," + url + "\n")
+                    self.m3u_file.write(
+                        f'#EXTINF:-1 tvg-name="{name}" group-title="{cate}",{name}\n{url}\n'
+                    )
+        self.txt_file.write("\n")
+        self.completed.append(cate)
+        self.sync()
+
+    def sync(self):
+        """
+        Sync the results to disk, then record the checkpoint
+        """
+        for f in (self.txt_file, self.m3u_file):
+            f.flush()
+            os.fsync(f.fileno())
+        checkpoint = {
+            "completed": self.completed,
+            "txt_offset": self.txt_file.tell(),
+            "m3u_offset": self.m3u_file.tell(),
+        }
+        saveJsonAtomic(self.checkpoint_path, checkpoint, "checkpoint", sync=True)
+
+    def close(self, finished=True):
+        """
+        Close the results, the checkpoint is removed once the run finished
+        """
+        for f in (self.txt_file, self.m3u_file):
+            if f is not None:
+                f.close()
+        if finished and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+
+class RunCheckpoint:
+    """
+    Per-channel progress of the run: the collected candidates and the results,
+    saved periodically so an interrupted run can resume without redoing them
+    """
+
+    def __init__(self, path="result_new.progress.json", interval=None):
+        self.path = path
+        self.interval = (
+            interval
+            if interval is not None
+            else getSettings().checkpoint_interval
+        )
+        self.channels = {}
+        self.saved_time = time.time()
+
+    def load(self):
+        """
+        Load the progress of the interrupted run
+        """
+        self.channels = loadJson(self.path, "progress", {}).get("channels", {})
+        return self
+
+    def save(self):
+        """
+        Save the progress, and the probe results with it
+        """
+        saveJsonAtomic(self.path, {"channels": self.channels}, "progress")
+        saveProbeCache()
+        self.saved_time = time.time()
+
+    def saveIfDue(self):
+        """
+        Save the progress if the interval passed since the last save
+        """
+        if time.time() - self.saved_time >= self.interval:
+            self.save()
+
+    def getChannel(self, cate, name):
+        """
+        Get the progress of the channel
+        """
+        return self.channels.get(cate, {}).get(name, {})
+
+    def setCandidates(self, cate, name, candidates):
+        """
+        Set the collected candidates of the channel
+        """
+        self.channels.setdefault(cate, {}).setdefault(name, {})["candidates"] = [
+            list(candidate) for candidate in candidates
+        ]
+        self.saveIfDue()
+
+    def setResult(self, cate, name, urls):
+        """
+        Set the result of the channel
+        """
+        self.channels.setdefault(cate, {}).setdefault(name, {})["urls"] = urls
+        self.saveIfDue()
+
+    def remove(self):
+        """
+        Remove the progress once the run finished
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
 
 
 def updateFile(final_file, old_file):
@@ -146,102 +1073,1058 @@ def updateFile(final_file, old_file):
         os.replace(old_file, final_file)
 
 
-def getUrlInfo(result):
+url_pattern = re.compile(
+    r"http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+"
+)
+
+
+class SearchResultParser(HTMLParser):
+    """
+    One pass extractor of the search results page, without building a tree: the
+    texts of the visible child divs of each result div, and the link hrefs
+    """
+
+    void_tags = {
+        "area", "base", "br", "col", "embed", "hr", "img", "input",
+        "link", "meta", "param", "source", "track", "wbr",
+    }
+
+    def __init__(self, result_class):
+        super().__init__(convert_charrefs=True)
+        self.result_class = result_class
+        self.results = []
+        self.links = []
+        # Open tags, with the texts of the result div or of its child div
+        self.stack = []
+        self.result = None
+        self.child = None
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "a" and attrs.get("href") is not None:
+            self.links.append(attrs["href"])
+        if tag in self.void_tags:
+            return
+        role = None
+        if tag == "div":
+            if self.result is None:
+                if self.result_class in (attrs.get("class") or "").split():
+                    self.result = []
+                    role = "result"
+            elif self.child is None and self.stack[-1][1] == "result":
+                style = attrs.get("style")
+                self.child = [not style or "none" not in style]
+                role = "child"
+        if tag in ("script", "style"):
+            self.skip += 1
+        self.stack.append((tag, role))
+
+    def handle_endtag(self, tag):
+        # Like the tree builders, close up to the latest open tag of the name
+        for index in range(len(self.stack) - 1, -1, -1):
+            if self.stack[index][0] == tag:
+                while len(self.stack) > index:
+                    self.popTag()
+                return
+
+    def popTag(self):
+        tag, role = self.stack.pop()
+        if tag in ("script", "style"):
+            self.skip -= 1
+        if role == "child":
+            visible, *texts = self.child
+            text = "".join(texts)
+            if visible and text:
+                self.result.append(text)
+            self.child = None
+        elif role == "result":
+            self.results.append(self.result)
+            self.result = None
+
+    def handle_data(self, data):
+        if self.child is not None and not self.skip:
+            text = data.strip()
+            if text:
+                self.child.append(text)
+
+    def close(self):
+        super().close()
+        while self.stack:
+            self.popTag()
+
+
+def getSearchResults(page_source, result_class):
+    """
+    Get the child div texts of the results and the link hrefs of the page
+    """
+    parser = SearchResultParser(result_class)
+    parser.feed(page_source)
+    parser.close()
+    return parser.results, parser.links
+
+
+def getUrlInfo(result_texts):
     """
-    Get the url, date and resolution
+    Get the url, date, resolution and channel name from the texts of the result
     """
     url = date = resolution = channel_name = None
-    result_div = [div for div in result.children if div.name == "div" and div.get_text(strip=True) and (not div.attrs.get('style') or not 'none' in div.attrs.get('style'))]
-    if 1 < len(result_div):
-        channel_name = result_div[0].get_text(strip=True)
-        channel_text = result_div[1].get_text(strip=True)
-        url_match = re.search(
-            r"http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+",
-            channel_text,
-        )
+    if 1 < len(result_texts):
+        channel_name = result_texts[0]
+        url_match = url_pattern.search(result_texts[1])
         if url_match is not None:
             url = url_match.group()
-        info_text = result_div[-1].get_text(strip=True)
-        if info_text:
-            date, resolution = (
-                (info_text.partition(" ")[0] if info_text.partition(" ")[0] else None),
-                (
-                    info_text.partition(" ")[2].partition("•")[2].partition(" ")[0]
-                    if info_text.partition(" ")[2].partition("•")[2]
-                    else None
-                ),
-            )
+        date_text, _, info_text = result_texts[-1].partition(" ")
+        date = date_text or None
+        detail = info_text.partition("•")[2]
+        resolution = detail.partition(" ")[0] if detail else None
     return url, date, resolution, channel_name
 
 
-async def getSpeed(url, urlTimeout=5):
+class ProbeEngine:
     """
-    Get the speed of the url
+    Shared probe engine: one pooled session, global and per-host concurrency limits
     """
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
-        start = time.time()
+
+    def __init__(self, concurrency=None, per_host=None):
+        self.concurrency = concurrency or getSettings().probe_concurrency
+        self.per_host = per_host or getSettings().probe_per_host
+        self.adaptive = getSettings().probe_adaptive
+        self.session = None
+        self.semaphore = None
+        self.host_semaphores = {}
+        # Response times (ms) of the latest successful probes
+        self.latencies = deque(maxlen=500)
+        self.host_fail_threshold = getSettings().probe_host_fail_threshold
+        self.host_stats = {}
+
+    def getSession(self):
+        """
+        Get the pooled session, create it on first use inside the running loop
+        """
+        if self.session is None or self.session.closed:
+            # The semaphores are the probe limits, the connector leaves room
+            # for the hedged requests on top of them
+            connector = aiohttp.TCPConnector(
+                ssl=False,
+                limit=self.concurrency * 2,
+                limit_per_host=self.per_host * 2,
+                ttl_dns_cache=300,
+            )
+            self.session = aiohttp.ClientSession(connector=connector)
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+            self.host_semaphores = {}
+        return self.session
+
+    def getHostSemaphore(self, host):
+        """
+        Get the semaphore that limits the concurrent probes of a host
+        """
+        semaphore = self.host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.per_host)
+            self.host_semaphores[host] = semaphore
+        return semaphore
+
+    def getHostStat(self, host):
+        """
+        Get the probe stats of the host
+        """
+        stat = self.host_stats.get(host)
+        if stat is None:
+            stat = self.host_stats[host] = {
+                "probes": 0,
+                "alive": 0,
+                "failures": 0,
+                "consecutive_failures": 0,
+                "skipped": 0,
+                "timeouts": 0,
+                "total_time": 0,
+                "open": False,
+            }
+        return stat
+
+    def recordHostResult(self, stat, response_time, reachable, timeout=False):
+        """
+        Record a probe result of the host. Consecutive connection failures or
+        timeouts over the threshold open the circuit for the rest of the run,
+        an error status still counts as a reachable host
+        """
+        stat["probes"] += 1
+        if response_time != float("inf"):
+            stat["alive"] += 1
+            stat["total_time"] += response_time
+            getMetrics().observe("probe_latency", response_time)
+        if reachable:
+            stat["consecutive_failures"] = 0
+            return
+        stat["failures"] += 1
+        if timeout:
+            stat["timeouts"] += 1
+        stat["consecutive_failures"] += 1
+        if (
+            self.host_fail_threshold > 0
+            and stat["consecutive_failures"] >= self.host_fail_threshold
+        ):
+            stat["open"] = True
+
+    def getHostStats(self):
+        """
+        Get the probe stats of all hosts, with the average response time of the alive probes
+        """
+        return {
+            host: dict(
+                stat,
+                avg_time=int(stat["total_time"] / stat["alive"]) if stat["alive"] else None,
+            )
+            for host, stat in self.host_stats.items()
+        }
+
+    def getLatencyPercentile(self, percent):
+        """
+        Get the percentile of the observed response times in seconds,
+        None until there are enough samples
+        """
+        if len(self.latencies) < 20:
+            return None
+        latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * percent / 100))
+        return latencies[index] / 1000.0
+
+    def getTimeout(self, urlTimeout):
+        """
+        Get the probe timeout, adapted to the observed response times in adaptive mode
+        """
+        if not self.adaptive:
+            return urlTimeout
+        p95 = self.getLatencyPercentile(95)
+        if p95 is None:
+            return urlTimeout
+        return min(urlTimeout, max(1.0, p95 * 3))
+
+    async def requestStatus(self, session, url, urlTimeout):
+        """
+        Get the response status of the url
+        """
+        async with session.get(
+            url, timeout=aiohttp.ClientTimeout(total=urlTimeout)
+        ) as response:
+            return response.status
+
+    async def requestStatusHedged(self, session, url, urlTimeout, hedgeDelay):
+        """
+        Get the response status of the url, send a second request if the first
+        one is not answered within the hedge delay, the first success wins
+        """
+        first = asyncio.ensure_future(self.requestStatus(session, url, urlTimeout))
+        tasks = [first]
         try:
-            async with session.get(url, timeout=urlTimeout) as response:
-                resStatus = response.status
-        except:
-            return float("inf")
-        end = time.time()
+            done, _ = await asyncio.wait({first}, timeout=hedgeDelay)
+            if done:
+                return first.result()
+            second = asyncio.ensure_future(
+                self.requestStatus(session, url, max(urlTimeout - hedgeDelay, 0.1))
+            )
+            tasks.append(second)
+            pending = {first, second}
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if not task.exception() and task.result() == 200:
+                        return 200
+            return first.result()
+        finally:
+            # Also on cancellation, no request outlives the probe slot
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def probe(self, url, urlTimeout=5):
+        """
+        Probe the url, the timeout only starts once a probe slot is acquired.
+        Return the response time, and whether the open circuit skipped the url
+        """
+        session = self.getSession()
+        host = urlparse(url).netloc
+        stat = self.getHostStat(host)
+        if stat["open"]:
+            stat["skipped"] += 1
+            return float("inf"), True
+        async with self.semaphore, self.getHostSemaphore(host):
+            # The circuit may have opened while waiting for the slot
+            if stat["open"]:
+                stat["skipped"] += 1
+                return float("inf"), True
+            urlTimeout = self.getTimeout(urlTimeout)
+            hedgeDelay = self.getLatencyPercentile(90) if self.adaptive else None
+            start = time.time()
+            try:
+                if hedgeDelay is not None and hedgeDelay < urlTimeout:
+                    resStatus = await self.requestStatusHedged(
+                        session, url, urlTimeout, hedgeDelay
+                    )
+                else:
+                    resStatus = await self.requestStatus(session, url, urlTimeout)
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                self.recordHostResult(stat, float("inf"), False, True)
+                return float("inf"), False
+            except:
+                self.recordHostResult(stat, float("inf"), False)
+                return float("inf"), False
+            end = time.time()
         if resStatus == 200:
-            return int(round((end - start) * 1000))
+            response_time = int(round((end - start) * 1000))
+            self.latencies.append(response_time)
         else:
-            return float("inf")
+            response_time = float("inf")
+        self.recordHostResult(stat, response_time, True)
+        return response_time, False
+
+    async def probeStream(self, url, urlTimeout=5):
+        """
+        Probe the stream quality of the url: response time, the resolution and
+        bandwidth declared by the hls playlist, and the throughput measured by
+        downloading one media segment within the byte and time budget, skipped
+        is set when the open circuit skipped the url
+        """
+        result = {
+            "response_time": float("inf"),
+            "resolution": None,
+            "bandwidth": None,
+            "speed": None,
+            "skipped": False,
+        }
+        session = self.getSession()
+        host = urlparse(url).netloc
+        stat = self.getHostStat(host)
+        segment_bytes = getSettings().probe_segment_bytes
+        segment_timeout = getSettings().probe_segment_timeout
+        if stat["open"]:
+            stat["skipped"] += 1
+            result["skipped"] = True
+            return result
+        async with self.semaphore, self.getHostSemaphore(host):
+            if stat["open"]:
+                stat["skipped"] += 1
+                result["skipped"] = True
+                return result
+            try:
+                start = time.time()
+                try:
+                    response = await session.get(
+                        url,
+                        timeout=aiohttp.ClientTimeout(total=self.getTimeout(urlTimeout)),
+                    )
+                except asyncio.CancelledError:
+                    raise
+                except asyncio.TimeoutError:
+                    self.recordHostResult(stat, float("inf"), False, True)
+                    return result
+                except:
+                    self.recordHostResult(stat, float("inf"), False)
+                    return result
+                async with response:
+                    if response.status != 200:
+                        self.recordHostResult(stat, float("inf"), True)
+                        return result
+                    result["response_time"] = int(round((time.time() - start) * 1000))
+                    self.latencies.append(result["response_time"])
+                    self.recordHostResult(stat, result["response_time"], True)
+                    # Enough of the body to tell a playlist from the stream itself
+                    head = await readBody(response, 64)
+                    if not head.lstrip().startswith(b"#EXTM3U"):
+                        # Not a playlist, the stream itself is measured
+                        speed_start = time.time()
+                        result["speed"] = await readSpeed(
+                            response, segment_bytes, segment_timeout,
+                            len(head), speed_start
+                        )
+                        return result
+                    head += await readBody(response, m3u8_max_bytes - len(head))
+                playlist_url = str(response.url)
+                playlist = parseM3u8(head.decode("utf-8", errors="ignore"), playlist_url)
+                if playlist["variants"]:
+                    variant = max(playlist["variants"], key=lambda v: v["bandwidth"] or 0)
+                    result["resolution"] = variant["resolution"]
+                    result["bandwidth"] = variant["bandwidth"]
+                    async with session.get(
+                        variant["url"], timeout=aiohttp.ClientTimeout(total=urlTimeout)
+                    ) as response:
+                        if response.status != 200:
+                            return result
+                        playlist = parseM3u8(
+                            (await readBody(response, m3u8_max_bytes)).decode(
+                                "utf-8", errors="ignore"
+                            ),
+                            str(response.url),
+                        )
+                if playlist["segments"]:
+                    # The last segment is the live edge, the least likely expired
+                    speed_start = time.time()
+                    async with session.get(
+                        playlist["segments"][-1],
+                        timeout=aiohttp.ClientTimeout(total=segment_timeout),
+                    ) as response:
+                        if response.status == 200:
+                            result["speed"] = await readSpeed(
+                                response, segment_bytes, segment_timeout, 0, speed_start
+                            )
+            except asyncio.CancelledError:
+                raise
+            except:
+                pass
+        return result
+
+    async def close(self):
+        """
+        Close the pooled session
+        """
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+
+m3u8_max_bytes = 256 * 1024
+m3u8_attribute_pattern = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+def parseM3u8(content, base_url):
+    """
+    Parse the hls playlist into its variants (url, resolution, bandwidth)
+    and media segment urls
+    """
+    variants = []
+    segments = []
+    stream_info = None
+    segment_next = False
+    for line in content.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("#EXT-X-STREAM-INF:"):
+            stream_info = dict(
+                (key, value.strip('"'))
+                for key, value in m3u8_attribute_pattern.findall(line.partition(":")[2])
+            )
+        elif line.startswith("#EXTINF"):
+            segment_next = True
+        elif not line.startswith("#"):
+            line_url = urllib.parse.urljoin(base_url, line)
+            if stream_info is not None:
+                bandwidth = stream_info.get("BANDWIDTH")
+                variants.append(
+                    {
+                        "url": line_url,
+                        "resolution": stream_info.get("RESOLUTION"),
+                        "bandwidth": int(bandwidth) if bandwidth and bandwidth.isdigit() else None,
+                    }
+                )
+                stream_info = None
+            elif segment_next:
+                segments.append(line_url)
+                segment_next = False
+    return {"variants": variants, "segments": segments}
+
+
+async def readBody(response, max_bytes):
+    """
+    Read the response body until its end or the byte cap, a single read only
+    returns what has been received so far
+    """
+    data = b""
+    while len(data) < max_bytes:
+        chunk = await response.content.read(max_bytes - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+async def readSpeed(response, max_bytes, timeout, read_bytes=0, start=None):
+    """
+    Read the response body within the byte and time budget, get the throughput in kbps
+    """
+    start = start or time.time()
+    deadline = start + timeout
+    try:
+        while read_bytes < max_bytes:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            chunk = await asyncio.wait_for(
+                response.content.read(min(64 * 1024, max_bytes - read_bytes)),
+                remaining,
+            )
+            if not chunk:
+                break
+            read_bytes += len(chunk)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.time() - start
+    if read_bytes == 0 or elapsed <= 0:
+        return None
+    return int(read_bytes * 8 / 1000 / elapsed)
+
+
+probe_engine = None
+
+
+def getProbeEngine():
+    """
+    Get the process-wide probe engine
+    """
+    global probe_engine
+    if probe_engine is None:
+        probe_engine = ProbeEngine()
+    return probe_engine
+
+
+def logProbeHostStats():
+    """
+    Log the probe stats of the hosts, the hosts with failures first
+    """
+    if probe_engine is None:
+        return
+    stats = probe_engine.getHostStats()
+    for host, stat in sorted(
+        stats.items(), key=lambda item: (-item[1]["failures"], item[0])
+    ):
+        avg_time = f"{stat['avg_time']}ms" if stat["avg_time"] is not None else "-"
+        logging.info(
+            f"Host: {host}, Probes: {stat['probes']}, Alive: {stat['alive']}, Failures: {stat['failures']}, Skipped: {stat['skipped']}, Avg Time: {avg_time}, Circuit: {'open' if stat['open'] else 'closed'}"
+        )
+    opened = sum(1 for stat in stats.values() if stat["open"])
+    skipped = sum(stat["skipped"] for stat in stats.values())
+    if opened:
+        print(f"Circuit opened for {opened} hosts, {skipped} probes skipped")
+
+
+async def closeProbeEngine():
+    """
+    Close the process-wide probe engine
+    """
+    global probe_engine
+    if probe_engine is not None:
+        await probe_engine.close()
+        probe_engine = None
+
+
+class RunMetrics:
+    """
+    Stage timings, counters and histograms of the run, emitted as json lines
+    or as a prometheus textfile
+    """
+
+    # Upper bounds (ms) of the histogram buckets
+    buckets = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        # Stage name -> [calls, total seconds]
+        self.stages = {}
+        # (name, labels) -> value
+        self.counters = {}
+        # Name -> {"buckets": [...], "count": n, "sum": ms}
+        self.histograms = {}
+        self.channels = []
+        self.host_stats = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time the block as a stage, repeated stages are summed
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.addStage(name, time.time() - start)
+
+    def addStage(self, name, seconds):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0, 0])
+            stage[0] += 1
+            stage[1] += seconds
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value):
+        """
+        Add the value (ms) to the histogram
+        """
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {
+                    "buckets": [0] * (len(self.buckets) + 1),
+                    "count": 0,
+                    "sum": 0,
+                }
+            index = next(
+                (i for i, bound in enumerate(self.buckets) if value <= bound),
+                len(self.buckets),
+            )
+            histogram["buckets"][index] += 1
+            histogram["count"] += 1
+            histogram["sum"] += value
+
+    def addChannel(self, cate, name, **values):
+        """
+        Record the timings (seconds) and counts of the channel
+        """
+        with self.lock:
+            self.channels.append(dict(cate=cate, name=name, **values))
+        for key in ("collect", "probe"):
+            if values.get(key) is not None:
+                self.observe(f"channel_{key}", values[key] * 1000)
+
+    def setHostStats(self, host_stats):
+        self.host_stats = host_stats
+
+    def getCacheHitRate(self, cache):
+        """
+        Get the hits and lookups of the cache
+        """
+        hits = self.counters.get(("cache", (("cache", cache), ("result", "hit"))), 0)
+        misses = self.counters.get(("cache", (("cache", cache), ("result", "miss"))), 0)
+        return hits, hits + misses
+
+    def getSummary(self):
+        """
+        Get the end of run summary text
+        """
+        lines = [f"Run summary: {time.time() - self.start:.1f}s"]
+        if self.stages:
+            lines.append(
+                "  Stages: "
+                + ", ".join(
+                    f"{name} {seconds:.1f}s" for name, (_, seconds) in self.stages.items()
+                )
+            )
+        for name, histogram in self.histograms.items():
+            lines.append(
+                f"  {name}: {histogram['count']}, avg {histogram['sum'] / histogram['count']:.0f}ms"
+            )
+        for cache in ("probe", "extend"):
+            hits, lookups = self.getCacheHitRate(cache)
+            if lookups:
+                lines.append(
+                    f"  {cache} cache: {hits}/{lookups} hits ({hits / lookups:.0%})"
+                )
+        timeouts = {
+            host: stat["timeouts"]
+            for host, stat in self.host_stats.items()
+            if stat.get("timeouts")
+        }
+        if timeouts:
+            worst = sorted(timeouts.items(), key=lambda item: -item[1])[:3]
+            lines.append(
+                f"  Timeouts: {sum(timeouts.values())} on {len(timeouts)} hosts, most on "
+                + ", ".join(f"{host} ({count})" for host, count in worst)
+            )
+        return "\n".join(lines)
+
+    def getRecords(self):
+        """
+        Get the metrics as json records
+        """
+        records = [
+            {"type": "stage", "stage": name, "calls": calls, "seconds": round(seconds, 3)}
+            for name, (calls, seconds) in self.stages.items()
+        ]
+        records += [
+            {"type": "counter", "name": name, "labels": dict(labels), "value": value}
+            for (name, labels), value in self.counters.items()
+        ]
+        records += [
+            {
+                "type": "histogram",
+                "name": name,
+                "buckets": dict(
+                    zip([*map(str, self.buckets), "+Inf"], histogram["buckets"])
+                ),
+                "count": histogram["count"],
+                "sum": round(histogram["sum"], 3),
+            }
+            for name, histogram in self.histograms.items()
+        ]
+        records += [
+            {"type": "host", "host": host, **stat} for host, stat in self.host_stats.items()
+        ]
+        records += [{"type": "channel", **channel} for channel in self.channels]
+        return records
+
+    def getPrometheusText(self):
+        """
+        Get the metrics in the prometheus text format, without the channel records
+        """
+
+        def formatLabels(labels):
+            return (
+                "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+                if labels
+                else ""
+            )
+
+        lines = ["# TYPE tv_stage_seconds gauge"]
+        lines += [
+            f'tv_stage_seconds{{stage="{name}"}} {seconds:.3f}'
+            for name, (_, seconds) in self.stages.items()
+        ]
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f"# TYPE tv_{name}_total counter")
+            lines += [
+                f"tv_{name}_total{formatLabels(labels)} {value}"
+                for (counter, labels), value in self.counters.items()
+                if counter == name
+            ]
+        for name, histogram in self.histograms.items():
+            lines.append(f"# TYPE tv_{name}_ms histogram")
+            total = 0
+            for bound, count in zip(
+                [*map(str, self.buckets), "+Inf"], histogram["buckets"]
+            ):
+                total += count
+                lines.append(f'tv_{name}_ms_bucket{{le="{bound}"}} {total}')
+            lines.append(f"tv_{name}_ms_sum {histogram['sum']:.3f}")
+            lines.append(f"tv_{name}_ms_count {histogram['count']}")
+        for key in ("probes", "failures", "timeouts", "skipped"):
+            lines.append(f"# TYPE tv_host_{key}_total counter")
+            lines += [
+                f'tv_host_{key}_total{{host="{host}"}} {stat[key]}'
+                for host, stat in self.host_stats.items()
+            ]
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Write the metrics to the path, a prometheus textfile if it ends with .prom,
+        json lines otherwise
+        """
+        with self.lock:
+            if path.endswith(".prom"):
+                text = self.getPrometheusText()
+            else:
+                text = "".join(
+                    json.dumps(record, ensure_ascii=False) + "\n"
+                    for record in self.getRecords()
+                )
+        return writeFileAtomic(path, text, "metrics")
+
+
+run_metrics = None
+
+
+def getMetrics():
+    """
+    Get the process-wide run metrics
+    """
+    global run_metrics
+    if run_metrics is None:
+        run_metrics = RunMetrics()
+    return run_metrics
+
+
+def writeRunMetrics(path=None):
+    """
+    Collect the probe host stats into the run metrics and write them to the path
+    """
+    metrics = getMetrics()
+    if probe_engine is not None:
+        metrics.setHostStats(probe_engine.getHostStats())
+    if path:
+        try:
+            metrics.write(path)
+        except Exception as e:
+            print(f"Error on writing metrics: {e}")
+
+
+class ProbeCache:
+    """
+    Persistent probe result cache keyed by url, with ttl and lru eviction
+    """
+
+    def __init__(self, path=None, ttl=None, negative_ttl=None, size=None):
+        self.path = path or getSettings().probe_cache_file
+        self.ttl = (ttl if ttl is not None else getSettings().probe_cache_ttl) * 3600
+        self.negative_ttl = (
+            negative_ttl
+            if negative_ttl is not None
+            else getSettings().probe_cache_negative_ttl
+        ) * 3600
+        self.size = size or getSettings().probe_cache_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """
+        Load the cache file, drop the expired entries
+        """
+        data = loadJson(self.path, "probe cache", {})
+        now = time.time()
+        for url, entry in data.items():
+            if self.isFresh(entry, now):
+                self.entries[url] = entry
+        return self
+
+    def save(self):
+        """
+        Save the cache file, evict the least recently used entries over the size
+        """
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        saveJsonAtomic(self.path, self.entries, "probe cache")
+
+    def isFresh(self, entry, now=None):
+        """
+        Check if the entry is within its ttl, dead urls use the negative ttl
+        """
+        ttl = self.ttl if entry.get("status") == "alive" else self.negative_ttl
+        return (now or time.time()) - entry.get("time", 0) < ttl
+
+    def get(self, url):
+        """
+        Get the fresh entry of the url
+        """
+        entry = self.entries.get(url)
+        if entry is None or not self.isFresh(entry):
+            self.misses += 1
+            return None
+        self.entries.move_to_end(url)
+        self.hits += 1
+        return entry
+
+    def set(self, url, response_time, resolution=None, speed=None):
+        """
+        Set the probe result of the url
+        """
+        alive = response_time != float("inf")
+        self.entries[url] = {
+            "response_time": response_time if alive else None,
+            "status": "alive" if alive else "dead",
+            "resolution": resolution,
+            "speed": speed,
+            "time": time.time(),
+        }
+        self.entries.move_to_end(url)
+
+
+probe_cache = None
+
+
+def getProbeCache():
+    """
+    Get the process-wide probe cache, None if disabled
+    """
+    global probe_cache
+    if probe_cache is None and getSettings().probe_cache_ttl > 0:
+        probe_cache = ProbeCache().load()
+    return probe_cache
+
+
+def saveProbeCache():
+    """
+    Save the process-wide probe cache
+    """
+    if probe_cache is not None:
+        probe_cache.save()
+
+
+async def getSpeed(url, urlTimeout=5, useCache=True):
+    """
+    Get the speed of the url
+    """
+    cache = getProbeCache() if useCache else None
+    if cache is not None:
+        entry = cache.get(url)
+        getMetrics().count("cache", cache="probe", result="miss" if entry is None else "hit")
+        if entry is not None:
+            response_time = entry["response_time"]
+            return response_time if response_time is not None else float("inf")
+    engine = getProbeEngine()
+    response_time, skipped = await engine.probe(url, urlTimeout)
+    # Urls failed fast by an open circuit were not really probed
+    if cache is not None and not skipped:
+        cache.set(url, response_time)
+    return response_time
+
+
+async def getStreamQuality(url, urlTimeout=5):
+    """
+    Get the response time, resolution and measured speed (kbps) of the stream
+    """
+    cache = getProbeCache()
+    if cache is not None:
+        entry = cache.get(url)
+        # Entries of a plain probe have no speed and are probed again
+        hit = entry is not None and (entry["status"] == "dead" or entry.get("speed"))
+        getMetrics().count("cache", cache="probe", result="hit" if hit else "miss")
+        if hit:
+            response_time = entry["response_time"]
+            return (
+                response_time if response_time is not None else float("inf"),
+                entry.get("resolution"),
+                entry.get("speed"),
+            )
+    engine = getProbeEngine()
+    result = await engine.probeStream(url, urlTimeout)
+    if cache is not None and not result["skipped"]:
+        cache.set(url, result["response_time"], result["resolution"], result["speed"])
+    return result["response_time"], result["resolution"], result["speed"]
+
+
+async def gatherProbes(probes, isAlive, failed):
+    """
+    Gather the probe results in order. In adaptive mode, once enough alive
+    candidates for the urls limit are confirmed, the remaining probes get a
+    grace period as long as it took so far, then they are dropped as failed
+    """
+    tasks = [asyncio.ensure_future(probe) for probe in probes]
+    if not getSettings().probe_adaptive:
+        return await asyncio.gather(*tasks)
+    target = getSettings().urls_limit * 2
+    start = time.time()
+    deadline = None
+    alive = 0
+    pending = set(tasks)
+    try:
+        while pending:
+            timeout = None if deadline is None else max(deadline - time.time(), 0)
+            done, pending = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                break
+            alive += sum(1 for task in done if isAlive(task.result()))
+            if deadline is None and alive >= target:
+                deadline = time.time() + max(time.time() - start, 0.2)
+    finally:
+        for task in pending:
+            task.cancel()
+    return [
+        task.result() if task.done() and not task.cancelled() else failed
+        for task in tasks
+    ]
 
 
 async def sortUrlsBySpeedAndResolution(infoList):
     """
     Sort by speed and resolution
     """
-    response_times = await asyncio.gather(*(getSpeed(url) for url, _, _, _ in infoList))
+    speeds = {}
+    if getSettings().probe_stream:
+        qualities = await gatherProbes(
+            (getStreamQuality(url) for url, _, _, _ in infoList),
+            lambda quality: quality[0] != float("inf"),
+            (float("inf"), None, None),
+        )
+        response_times = []
+        for i, (response_time, resolution, speed) in enumerate(qualities):
+            url, date, info_resolution, channel_name = infoList[i]
+            if resolution:
+                # The measured resolution is more reliable than the declared one
+                infoList[i] = (url, date, resolution, channel_name)
+            speeds[url] = speed or 0
+            response_times.append(response_time)
+    else:
+        response_times = await gatherProbes(
+            (getSpeed(url) for url, _, _, _ in infoList),
+            lambda response_time: response_time != float("inf"),
+            float("inf"),
+        )
     valid_responses = [
         (info, rt) for info, rt in zip(infoList, response_times) if rt != float("inf")
     ]
+    scores = getUrlScores(valid_responses, speeds)
+    order = sorted(range(len(valid_responses)), key=scores.__getitem__, reverse=True)
+    return [valid_responses[i] for i in order]
+
+
+resolution_pattern = re.compile(r"(\d+)x(\d+)")
 
-    def extract_resolution(resolution_str):
-        numbers = re.findall(r"\d+x\d+", resolution_str)
-        if numbers:
-            width, height = map(int, numbers[0].split("x"))
-            return width * height / 1000.0
-        else:
-            return 768 * 576 / 1000.0
 
+@lru_cache(maxsize=4096)
+def extract_resolution(resolution_str):
+    """
+    Get the resolution value (kilopixels) of the resolution text
+    """
+    match = resolution_pattern.search(resolution_str)
+    if match:
+        return int(match.group(1)) * int(match.group(2)) / 1000.0
+    else:
+        return 768 * 576 / 1000.0
+
+
+@lru_cache(maxsize=4096)
+def parse_date(date_str):
+    """
+    Parse the date text of the search result, None if it is not a valid date
+    """
+    try:
+        return datetime.datetime.strptime(date_str, "%m-%d-%Y")
+    except ValueError:
+        return None
+
+
+def getRankingWeights(has_speed=False):
+    """
+    Get the response time, resolution and speed weights, the defaults if invalid
+    """
     default_response_time_weight = 0.5
     default_resolution_weight = 0.5
-    response_time_weight = getattr(
-        config, "response_time_weight", default_response_time_weight
-    )
-    resolution_weight = getattr(config, "resolution_weight", default_resolution_weight)
+    response_time_weight = getSettings().response_time_weight
+    resolution_weight = getSettings().resolution_weight
+    speed_weight = getSettings().speed_weight if has_speed else 0
     # Check if weights are valid
     if not (
         0 <= response_time_weight <= 1
         and 0 <= resolution_weight <= 1
-        and response_time_weight + resolution_weight == 1
+        and 0 <= speed_weight <= 1
+        and math.isclose(response_time_weight + resolution_weight + speed_weight, 1)
     ):
-        response_time_weight = default_response_time_weight
-        resolution_weight = default_resolution_weight
+        return default_response_time_weight, default_resolution_weight, 0
+    return response_time_weight, resolution_weight, speed_weight
+
 
-    def combined_key(item):
-        (_, _, resolution, _), response_time = item
+def getUrlScores(data, speeds=None):
+    """
+    Get the combined scores of the probed urls as one column, the resolution
+    text of each url is parsed only once
+    """
+    speeds = speeds or {}
+    response_time_weight, resolution_weight, speed_weight = getRankingWeights(
+        bool(speeds)
+    )
+    scores = array("d", bytes(8 * len(data)))
+    for i, ((url, _, resolution, _), response_time) in enumerate(data):
         resolution_value = extract_resolution(resolution) if resolution else 0
-        return (
+        # Scale kbps to the same order of magnitude as the resolution value
+        speed_value = speeds.get(url, 0) / 10.0
+        scores[i] = (
             -(response_time_weight * response_time)
             + resolution_weight * resolution_value
+            + speed_weight * speed_value
         )
-
-    sorted_res = sorted(valid_responses, key=combined_key, reverse=True)
-    return sorted_res
+    return scores
 
 
 def filterByDate(data):
     """
-    Filter by date and limit
+    Filter by date and limit in one pass over the data sorted by score: the recent
+    (or undated) urls first, filled up with the older ones, and the best ipv6 url
+    takes the last slot if none made it into the recent ones
     """
     default_recent_days = 60
-    use_recent_days = getattr(config, "recent_days", 60)
+    use_recent_days = getSettings().recent_days
     if (
         not isinstance(use_recent_days, int)
         or use_recent_days <= 0
@@ -249,27 +2132,27 @@ def filterByDate(data):
     ):
         use_recent_days = default_recent_days
     start_date = datetime.datetime.now() - datetime.timedelta(days=use_recent_days)
+    limit = getSettings().urls_limit
     recent_data = []
+    recent_count = 0
     unrecent_data = []
-    for (url, date, resolution, channel_name), response_time in data:
-        if date:
-            date = datetime.datetime.strptime(date, "%m-%d-%Y")
-            if date >= start_date:
-                recent_data.append(((url, date, resolution, channel_name), response_time))
-            else:
-                unrecent_data.append(((url, date, resolution, channel_name), response_time))
-        else:
-            recent_data.append(((url, date, resolution, channel_name), response_time))
-    if len(recent_data) < config.urls_limit:
-        recent_data.extend(unrecent_data[: config.urls_limit - len(recent_data)])
-    else:
-        for i in range(len(recent_data)):
-            (url, date, resolution, channel_name), response_time = recent_data[i]
-            if is_ipv6(url):
-                if i >= config.urls_limit:
-                    recent_data[config.urls_limit-1] = recent_data[i]
-                break
-    return recent_data[: config.urls_limit]
+    ipv6_item = None
+    for item in data:
+        (url, date, _, _), _ = item
+        parsed_date = parse_date(date) if date else None
+        if parsed_date is None or parsed_date >= start_date:
+            if ipv6_item is None and is_ipv6(url):
+                ipv6_item = (recent_count, item)
+            if recent_count < limit:
+                recent_data.append(item)
+            recent_count += 1
+        elif len(unrecent_data) < limit:
+            unrecent_data.append(item)
+    if recent_count < limit:
+        recent_data.extend(unrecent_data[: limit - recent_count])
+    elif ipv6_item is not None and ipv6_item[0] >= limit:
+        recent_data[limit - 1] = ipv6_item[1]
+    return recent_data
 
 
 def getTotalUrls(data):
@@ -277,89 +2160,192 @@ def getTotalUrls(data):
     Get the total urls with filter by date and depulicate
     """
     total_urls = []
-    if len(data) > config.urls_limit:
+    if len(data) > getSettings().urls_limit:
         total_urls = [url for (url, _, _, _), _ in filterByDate(data)]
     else:
         total_urls = [url for (url, _, _, _), _ in data]
     return list(dict.fromkeys(total_urls))
 
 
-def is_ipv6(url):
+@lru_cache(maxsize=65536)
+def is_ipv6_host(host):
     """
-    Check if the url is ipv6
+    Check if the host is an ipv6 address
     """
+    if not host:
+        return False
     try:
-        host = urllib.parse.urlparse(url).hostname
         ipaddress.IPv6Address(host)
         return True
     except ValueError:
         return False
 
 
-def checkUrlIPVType(url):
+def is_ipv6(url):
     """
-    Check if the url is compatible with the ipv type in the config
+    Check if the url is ipv6
     """
-    ipv_type = getattr(config, "ipv_type", "ipv4")
-    if ipv_type == "ipv4":
-        return not is_ipv6(url)
-    elif ipv_type == "ipv6":
-        return is_ipv6(url)
-    else:
-        return True
+    try:
+        return is_ipv6_host(urlparse(url).hostname)
+    except ValueError:
+        return False
 
 
-def checkByDomainBlacklist(url):
+class UrlFilter:
     """
-    Check by domain blacklist
+    Url filter built once from the ipv type, domain blacklist and keywords blacklist
     """
-    domain_blacklist = [
-        urlparse(domain).netloc if urlparse(domain).scheme else domain
-        for domain in getattr(config, "domain_blacklist", [])
-    ]
-    return urlparse(url).netloc not in domain_blacklist
+
+    def __init__(self, ipv_type=None, domain_blacklist=None, url_keywords_blacklist=None):
+        self.ipv_type = (
+            ipv_type if ipv_type is not None else getSettings().ipv_type
+        )
+        if domain_blacklist is None:
+            domain_blacklist = getSettings().domain_blacklist
+        self.domain_blacklist = {
+            urlparse(domain).netloc if urlparse(domain).scheme else domain
+            for domain in domain_blacklist
+        }
+        if url_keywords_blacklist is None:
+            url_keywords_blacklist = getSettings().url_keywords_blacklist
+        keywords = sorted(
+            {keyword for keyword in url_keywords_blacklist if keyword},
+            key=len,
+            reverse=True,
+        )
+        self.keywords_pattern = (
+            re.compile("|".join(re.escape(keyword) for keyword in keywords))
+            if keywords
+            else None
+        )
+
+    def check(self, url):
+        """
+        Check the url, it is parsed only once
+        """
+        try:
+            parsed = urlparse(url)
+            if self.ipv_type == "ipv4" or self.ipv_type == "ipv6":
+                if is_ipv6_host(parsed.hostname) != (self.ipv_type == "ipv6"):
+                    return False
+        except ValueError:
+            return False
+        if parsed.netloc in self.domain_blacklist:
+            return False
+        if self.keywords_pattern is not None and self.keywords_pattern.search(url):
+            return False
+        return True
+
+    def filter(self, urls):
+        """
+        Filter the urls in one pass
+        """
+        check = self.check
+        return [url for url in urls if check(url)]
 
 
-def checkByURLKeywordsBlacklist(url):
+url_filter = None
+
+
+def getUrlFilter():
     """
-    Check by URL blacklist keywords
+    Get the process-wide url filter
     """
-    url_keywords_blacklist = getattr(config, "url_keywords_blacklist", [])
-    return not any(keyword in url for keyword in url_keywords_blacklist)
+    global url_filter
+    if url_filter is None:
+        url_filter = UrlFilter()
+    return url_filter
 
 
 def checkUrlByPatterns(url):
     """
     Check the url by patterns
     """
-    return (
-        checkUrlIPVType(url)
-        and checkByDomainBlacklist(url)
-        and checkByURLKeywordsBlacklist(url)
-    )
+    return getUrlFilter().check(url)
 
 
 def filterUrlsByPatterns(urls):
     """
     Filter urls by patterns
     """
-    urls = [url for url in urls if checkUrlIPVType(url)]
-    urls = [url for url in urls if checkByDomainBlacklist(url)]
-    urls = [url for url in urls if checkByURLKeywordsBlacklist(url)]
-    return urls
+    return getUrlFilter().filter(urls)
+
+
+def getSearchFormRequest(html, pageUrl, name):
+    """
+    Get the method, url and data of submitting the search form with the name
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "html.parser")
+    for form in soup.find_all("form"):
+        text_input = form.find("input", attrs={"type": "text"})
+        if text_input is None:
+            continue
+        data = {}
+        submit_found = False
+        for field in form.find_all("input"):
+            field_name = field.get("name")
+            field_type = (field.get("type") or "text").lower()
+            if not field_name:
+                continue
+            if field is text_input:
+                data[field_name] = name
+            elif field_type == "submit":
+                # Like a click, only the first submit button is sent
+                if not submit_found:
+                    data[field_name] = field.get("value", "")
+                    submit_found = True
+            elif field_type not in ("button", "image", "reset", "checkbox", "radio"):
+                data[field_name] = field.get("value", "")
+        method = (form.get("method") or "get").lower()
+        action = urllib.parse.urljoin(pageUrl, form.get("action") or pageUrl)
+        return method, action, data
+    return None
+
+
+async def fetchSearchPage(session, method, url, data=None, urlTimeout=10):
+    """
+    Fetch the search page source over http
+    """
+    headers = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36"
+    }
+    kwargs = {"data": data} if method == "post" else {"params": data}
+    async with session.request(
+        method.upper(),
+        url,
+        headers=headers,
+        timeout=aiohttp.ClientTimeout(total=urlTimeout),
+        **kwargs,
+    ) as response:
+        response.raise_for_status()
+        return await response.text()
 
 
 async def useAccessibleUrl():
     """
-    Check if the url is accessible
+    Get the accessible search sites as (url, result class), the preferred first:
+    the faster ones, after them those whose results never passed probing lately
+    or that are persistently slow
     """
-    baseUrl1 = "http://www.foodieguide.com/iptvsearch/"
-    baseUrl2 = "http://tonkiang.us/"
-    speed1 = await getSpeed(baseUrl1, 30)
-    speed2 = await getSpeed(baseUrl2, 30)
-    if speed1 == float("inf") and speed2 == float("inf"):
-        return None
-    if speed1 < speed2:
-        return (baseUrl1, "resultplus")
-    else:
-        return (baseUrl2, "resultplus")
+    search_urls = getSettings().search_urls
+    speeds = await asyncio.gather(
+        *(getSpeed(url, 30, useCache=False) for url in search_urls)
+    )
+    registry = getSourceRegistry()
+    accessible = [
+        (url, speed)
+        for url, speed in zip(search_urls, speeds)
+        if speed != float("inf")
+    ]
+    if registry is not None:
+        for url, speed in accessible:
+            registry.recordFetch(url, 0, speed)
+    accessible.sort(
+        key=lambda item: (
+            registry is not None and registry.isUseless(item[0]),
+            item[1],
+        )
+    )
+    return [(url, "resultplus") for url, _ in accessible]
\ No newline at end of file